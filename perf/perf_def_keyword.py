@@ -0,0 +1,60 @@
+# Add '.' to path so running this file by itself also works
+import os
+import sys
+
+sys.path.append(os.path.realpath("."))
+
+import perf_helpers as perf
+
+import psll.lexer
+import psll.macros
+
+# The def keyword on programs with very many defs. Each def uses the previous one, and each one is then
+# used by an out, so every lookup of a name has to see through the whole stack of the defs.
+
+
+def program(n_defs: int) -> tuple:
+    defs = " ".join(f"(def d{i} (+ d{i - 1} 1))" for i in range(1, n_defs))
+    outs = " ".join(f"(out d{i})" for i in range(n_defs))
+    return psll.lexer.lex(f"(def d0 (1)) {defs} {outs}")
+
+
+def def_keyword(n_defs: int) -> perf.stats_result:
+    ast = program(n_defs)
+    T = perf.runtime(psll.macros.def_keyword, 1.0, 1, ast)
+    return perf.stats(T)
+
+
+def perf_defs_100() -> perf.stats_result:
+    return def_keyword(100)
+
+
+def perf_defs_1000() -> perf.stats_result:
+    return def_keyword(1000)
+
+
+def perf_defs_3000() -> perf.stats_result:
+    return def_keyword(3000)
+
+
+if __name__ == "__main__":
+    argv = sys.argv
+    if len(argv) == 2:
+        with open(argv[1], "w") as of:
+            of.write("benchmark_name center spread_upper spread_lower N\n")
+            loc = dict(locals())
+            for name, fun in loc.items():
+                if callable(fun) and name.startswith("perf_"):
+                    result = fun()
+                    result = [int(t * 1e9) for t in result[:-1]] + [result[-1]]
+                    of.write(f"{name} " + " ".join(f"{x:.0f}" for x in result) + "\n")
+    else:
+        print("running def keyword analysis")
+        print("center, spread_upper, spread_lower, n_runs")
+        print("time in us\n---")
+        loc = dict(locals())
+        for name, fun in loc.items():
+            if callable(fun) and name.startswith("perf_"):
+                result = fun()
+                result = [int(t * 1e6) for t in result[:-1]] + [result[-1]]
+                print(f"{name:<30} " + " ".join(f"{x:<10.0f}" for x in result))
@@ -0,0 +1,85 @@
+# Add '.' to path so running this file by itself also works
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.append(os.path.realpath("."))
+
+import perf_helpers as perf
+
+# Startup of the cli, as seen by `python -X importtime`. Each benchmark runs a fresh interpreter
+# several times, and reports the total (cumulative) import time of all the modules it loaded.
+
+N_RUNS = 20
+
+
+def import_time(args: list[str]) -> tuple[float, dict[str, float]]:
+    """Run `python -X importtime -m psll ...` and return the total import time, and the cumulative
+    import time of each top-level module, in seconds"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "psll", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    modules: dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self, cumulative, name = line[len("import time:") :].split("|")
+        if not name.startswith("  "):  # Only the top-level imports. The nested ones are indented further
+            modules[name.strip()] = int(cumulative) / 1e6
+    return sum(modules.values()), modules
+
+
+def startup(args: list[str]) -> perf.stats_result:
+    T = [import_time(args)[0] for _ in range(N_RUNS)]
+    return perf.stats(T)
+
+
+def perf_help() -> perf.stats_result:
+    """psll --help"""
+    return startup(["--help"])
+
+
+def perf_trivial_compile() -> perf.stats_result:
+    """Compile a one-line program, with no optimisations"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "trivial.psll")
+        with open(filename, "w") as f:
+            f.write('(out "Hello, World!")\n')
+        return startup(["compile", filename])
+
+
+if __name__ == "__main__":
+    argv = sys.argv
+    if len(argv) == 2:
+        with open(argv[1], "w") as of:
+            of.write("benchmark_name center spread_upper spread_lower N\n")
+            loc = dict(locals())
+            for name, fun in loc.items():
+                if callable(fun) and name.startswith("perf_"):
+                    result = fun()
+                    result = [int(t * 1e9) for t in result[:-1]] + [result[-1]]
+                    of.write(f"{name} " + " ".join(f"{x:.0f}" for x in result) + "\n")
+    else:
+        print("running startup analysis")
+        print("center, spread_upper, spread_lower, n_runs")
+        print("import time in us\n---")
+        loc = dict(locals())
+        for name, fun in loc.items():
+            if callable(fun) and name.startswith("perf_"):
+                result = fun()
+                result = [int(t * 1e6) for t in result[:-1]] + [result[-1]]
+                print(f"{name:<30} " + " ".join(f"{x:<10.0f}" for x in result))
+
+        print("\nslowest imports of a trivial compile (cumulative, us)\n---")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "trivial.psll")
+            with open(filename, "w") as f:
+                f.write('(out "Hello, World!")\n')
+            _, modules = import_time(["compile", filename])
+        for module, t in sorted(modules.items(), key=lambda item: -item[1])[:10]:
+            print(f"{module:<30} {int(t * 1e6)}")
@@ -0,0 +1,99 @@
+# Add '.' to path so running this file by itself also works
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from string import ascii_letters
+
+sys.path.append(os.path.realpath("."))
+
+import perf_helpers as perf
+
+import psll
+from psll.__main__ import find_pyra_rb
+
+# String literals compiled with and without --balance-strings. The compile time is benchmarked as usual, and
+# the size of the program (and the time the interpreter takes to run it, if pyra.rb can be found) is
+# printed alongside. The unbalanced 500 character string does not compile at all (too deep to process).
+
+LENGTHS = (50, 200, 500)
+
+
+def source(n: int) -> str:
+    return f'(out "{(ascii_letters * (n // len(ascii_letters) + 1))[:n]}")'
+
+
+def compile_time(n: int, balanced: bool) -> perf.stats_result:
+    optional = ("balance_strings",) if balanced else ()
+    T = perf.runtime(psll.compile_source, 1.0, 1, source(n), optional=optional)
+    return perf.stats(T)
+
+
+def perf_string_50() -> perf.stats_result:
+    return compile_time(50, balanced=False)
+
+
+def perf_string_50_balanced() -> perf.stats_result:
+    return compile_time(50, balanced=True)
+
+
+def perf_string_200() -> perf.stats_result:
+    return compile_time(200, balanced=False)
+
+
+def perf_string_200_balanced() -> perf.stats_result:
+    return compile_time(200, balanced=True)
+
+
+def perf_string_500_balanced() -> perf.stats_result:
+    return compile_time(500, balanced=True)
+
+
+def run_time(program: str, pyra: str) -> float:
+    """Time one run of the program with the pyramid scheme interpreter"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "program.pyra")
+        with open(filename, "w") as f:
+            f.write(program)
+        T: list[float] = perf.ncalls(
+            subprocess.run, 1, 1, ["ruby", pyra, filename], stdout=subprocess.DEVNULL, check=True
+        )
+        return T[0]
+
+
+if __name__ == "__main__":
+    argv = sys.argv
+    if len(argv) == 2:
+        with open(argv[1], "w") as of:
+            of.write("benchmark_name center spread_upper spread_lower N\n")
+            loc = dict(locals())
+            for name, fun in loc.items():
+                if callable(fun) and name.startswith("perf_"):
+                    result = fun()
+                    result = [int(t * 1e9) for t in result[:-1]] + [result[-1]]
+                    of.write(f"{name} " + " ".join(f"{x:.0f}" for x in result) + "\n")
+    else:
+        print("running string literal analysis")
+        print("center, spread_upper, spread_lower, n_runs")
+        print("compile time in us\n---")
+        loc = dict(locals())
+        for name, fun in loc.items():
+            if callable(fun) and name.startswith("perf_"):
+                result = fun()
+                result = [int(t * 1e6) for t in result[:-1]] + [result[-1]]
+                print(f"{name:<30} " + " ".join(f"{x:<10.0f}" for x in result))
+
+        pyra = find_pyra_rb(verbose=0) if shutil.which("ruby") else None
+        print("\nsize of the programs (and run time in ms)\n---")
+        for n in LENGTHS:
+            for balanced in (False, True):
+                name = f"string_{n}" + ("_balanced" if balanced else "")
+                try:
+                    result = psll.compile_source(source(n), optional=("balance_strings",) if balanced else ())
+                except RecursionError:
+                    print(f"{name:<30} too deep to compile")
+                    continue
+                bytes_, lines, width = result.metrics
+                run = f"{1000 * run_time(result.program, pyra):.0f}" if pyra else "n/a"
+                print(f"{name:<30} {bytes_:<10} {lines:<10} {width:<10} {run}")
@@ -9,10 +9,38 @@ class PsllSyntaxError(SyntaxError):
     pass
 
 
-from . import (  # noqa: F401, E402
-    build,
-    lexer,
-    macros,
-    optimisers,
-    preprocessor,
-)
+from typing import TYPE_CHECKING, Any  # noqa: E402
+
+if TYPE_CHECKING:
+    from . import (  # noqa: F401
+        build,
+        compiler,
+        lexer,
+        macros,
+        optimisers,
+        parser,
+        preprocessor,
+        server,
+    )
+    from .compiler import CompileResult, compile_source  # noqa: F401
+
+_SUBMODULES = ("build", "compiler", "lexer", "macros", "optimisers", "parser", "preprocessor", "server")
+_COMPILER_API = ("CompileResult", "compile_source")
+
+
+def __getattr__(name: str) -> Any:
+    """Import the submodules on their first use, such that `import psll` (and so the start of the
+    cli) does not pay for the ones which are not needed"""
+    if name in _SUBMODULES:
+        import importlib
+
+        return importlib.import_module(f".{name}", __name__)
+    if name in _COMPILER_API:
+        from . import compiler
+
+        return getattr(compiler, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_SUBMODULES, *_COMPILER_API])
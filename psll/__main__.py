@@ -1,18 +1,20 @@
+# The heavier modules (the compiler itself, the optimisers, subprocess, the download machinery, ...) are
+# imported inside the functions which need them, such that each subcommand only pays for what it uses.
 import argparse
-import hashlib
 import os
 import os.path as op
-import shutil
-import subprocess
 import sys
-import tempfile
+import time
 from typing import TYPE_CHECKING, Any, Callable, Optional, TypeVar
 
 if TYPE_CHECKING:
     from typing_extensions import TypeAlias
+
+    from . import optimisers
 else:
     TypeAlias = Any
 
+from contextlib import suppress
 from enum import Enum
 from functools import partial
 
@@ -36,6 +38,8 @@ class Subcommand(Enum):
     COMPILE = "compile"
     RUN = "run"
     COMPILE_AND_RUN = "compile-and-run"
+    OPTIMISE = "optimise"
+    SERVE = "serve"
     DOWNLOAD_PYRA = "download-pyra"
 
     def add_subcommand(self, subparsers: argparse._SubParsersAction) -> None:
@@ -117,7 +121,12 @@ def _(subparsers: argparse._SubParsersAction) -> None:
 
     compile_parser.add_argument(
         "input",
-        help=("Input file written in the pyramid scheme (lisp (like)) syntax, with the .psll expansion."),
+        help=(
+            "Input file written in the pyramid scheme (lisp (like)) syntax, with the .psll expansion."
+            " With -, the programs are read from stdin and written to stdout. Several programs can be"
+            " compiled in one go by separating them with NUL characters, and their outputs are separated"
+            " the same way."
+        ),
     )
 
     compile_parser.add_argument(
@@ -148,6 +157,42 @@ def _(subparsers: argparse._SubParsersAction) -> None:
         ),
     )
 
+    compile_parser.add_argument(
+        "--fold-constants",
+        action="store_true",
+        help=(
+            "Evaluate the arithmetic and comparisons of integer literals at compile time, for example"
+            " (+ 1 2 3) becomes 6. Off by default, since it changes the structure of the program."
+        ),
+    )
+
+    compile_parser.add_argument(
+        "--balance-strings",
+        action="store_true",
+        help=(
+            "Build the string literals as balanced trees of short chains of characters, rather than as one"
+            " long chain. Long strings make much smaller (and shallower) programs."
+        ),
+    )
+
+    compile_parser.add_argument(
+        "--hoist-constants",
+        action="store_true",
+        help=(
+            "Set the constants which are repeated in the program, such as strings, to variables at its start,"
+            " and use the variables instead. The constants are then only built once."
+        ),
+    )
+
+    compile_parser.add_argument(
+        "--eliminate-dead-stores",
+        action="store_true",
+        help=(
+            "Remove the sets of the variables which are never read, if the value has no side effects."
+            " With -v, print how many pyramids were removed."
+        ),
+    )
+
     compile_parser.add_argument(
         "-go",
         "--greedy-optimisation",
@@ -166,6 +211,212 @@ def _(subparsers: argparse._SubParsersAction) -> None:
             " Choose the most beneficial. This tends to result in wide source code."
         ),
     )
+    compile_parser.add_argument(
+        "-oo",
+        "--optimal",
+        action="store_true",
+        help=(
+            "Find the best way to group and wrap the top-level pyramids with dynamic programming over"
+            " the ranges of adjacent pyramids. It only groups whole ranges, so on its own it often does worse"
+            " than the considerate optimisation. It is best followed by it (-oo -co)."
+        ),
+    )
+    compile_parser.add_argument(
+        "-bo",
+        "--beam-search",
+        action="store_true",
+        help=(
+            "Keep several of the best candidates of each round of the optimisation, rather than just the"
+            " best one. Slower than the considerate optimisation, but less likely to get stuck."
+        ),
+    )
+    compile_parser.add_argument(
+        "-ao",
+        "--annealing",
+        action="store_true",
+        help=(
+            "Make random insertions, wrappings and regroupings of the pyramids, and keep them by a simulated"
+            " annealing schedule. Much faster than the considerate optimisation on very large programs."
+        ),
+    )
+    compile_parser.add_argument(
+        "-so",
+        "--subtree-optimisation",
+        action="store_true",
+        help=(
+            "Also regroup the statements in the bodies of the loop, do and ? keywords, at any depth."
+            " The other optimisations only work on the top-level pyramids."
+        ),
+    )
+    add_search_arguments(compile_parser)
+    add_checkpoint_arguments(compile_parser)
+    add_objective_arguments(compile_parser)
+    compile_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "Build the top-level pyramids in N worker processes (0 for all the cpus) before putting them"
+            " side-by-side. Only worth it for programs with very many top-level pyramids."
+        ),
+    )
+    compile_parser.add_argument(
+        "--pareto",
+        action="store_true",
+        help=(
+            "Also save the variants of the program which are not worse than each other in all of the bytes,"
+            " lines and width, as output.pareto-N.pyra. Requires -o."
+        ),
+    )
+    compile_parser.add_argument(
+        "--progress",
+        action="store_true",
+        help=(
+            "Print a progress line to stderr after each iteration of the greedy and considerate optimisations:"
+            " the best length so far, candidates evaluated per second, tree cache hit rate and iteration time."
+        ),
+    )
+    compile_parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Keep running, and compile the input again every time it changes. Only the top-level forms which"
+            " changed are processed and built again, so small edits recompile in milliseconds."
+        ),
+    )
+    compile_parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.5,
+        metavar="SECONDS",
+        help="How often --watch checks the input for changes. Default: 0.5.",
+    )
+    compile_parser.add_argument(
+        "--server",
+        default=None,
+        metavar="SOCKET",
+        help=(
+            "Send the program to the compile server listening on this socket (see the serve command),"
+            " rather than compiling it in this process."
+        ),
+    )
+
+
+def add_search_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options of the beam search and annealing optimisations"""
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        default=8,
+        help="Number of candidates kept in each round of the beam search optimisation. Default: 8.",
+    )
+    parser.add_argument(
+        "--time-limit",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help=(
+            "Stop the beam search or annealing optimisation after this many seconds,"
+            " and keep the best program found so far."
+        ),
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=10_000,
+        help="Number of random changes tried by the annealing optimisation. Default: 10000.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed of the annealing optimisation. The same seed always gives the same program.",
+    )
+
+
+def validate_search_options(args: argparse.Namespace) -> None:
+    """Validate the options of the beam search and annealing optimisations"""
+    if args.beam_width < 1:
+        raise ArgumentError("Beam width must be at least 1")
+    if args.time_limit is not None and args.time_limit <= 0:
+        raise ArgumentError("Time limit must be positive")
+    if args.iterations < 1:
+        raise ArgumentError("Number of iterations must be at least 1")
+
+
+def add_objective_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options which choose what the optimisations minimise"""
+    parser.add_argument(
+        "--objective",
+        choices=["bytes", "lines", "width", "area", "weighted"],
+        default="bytes",
+        help=(
+            "What the greedy, considerate and beam search optimisations minimise: the number of bytes, lines,"
+            " the width of the longest line, lines times width, or a weighted sum (see --weights)."
+            " Ties are broken by the number of bytes. Default: bytes."
+        ),
+    )
+    parser.add_argument(
+        "--weights",
+        default="1,0,0",
+        metavar="BYTES,LINES,WIDTH",
+        help="Weights of the bytes, lines and width for the weighted objective. Default: 1,0,0.",
+    )
+
+
+def validate_objective_options(args: argparse.Namespace) -> None:
+    """Validate the objective options, and parse the weights"""
+    try:
+        args.weights = tuple(float(w) for w in args.weights.split(","))
+    except ValueError:
+        raise ArgumentError(f"Invalid weights: {args.weights}") from None
+    if len(args.weights) != 3:
+        raise ArgumentError("Weights must be three numbers: bytes, lines and width")
+
+
+def add_checkpoint_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options for checkpointing and resuming the greedy and considerate optimisations"""
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        metavar="FILE",
+        help=(
+            "Save the state of the greedy or considerate optimisation to this file as it goes, such that"
+            " it can be resumed with --resume if it gets interrupted."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Save the checkpoint every N iterations of the optimisation. Default: 1.",
+    )
+    parser.add_argument(
+        "--checkpoint-seconds",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Also save the checkpoint if this many seconds have passed since the last save.",
+    )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        metavar="FILE",
+        help="Resume the optimisation from a checkpoint saved with --checkpoint.",
+    )
+
+
+def validate_checkpoint_options(args: argparse.Namespace) -> None:
+    """Validate the options for checkpointing and resuming"""
+    if args.checkpoint_every < 1:
+        raise ArgumentError("Checkpoint must be saved at least every 1 iteration")
+    if args.checkpoint_seconds is not None and args.checkpoint_seconds <= 0:
+        raise ArgumentError("Checkpoint interval must be positive")
+    if args.resume is not None and not op.exists(args.resume):
+        raise ArgumentError("Checkpoint file does not exist")
 
 
 # Compiler options
@@ -182,14 +433,51 @@ def _(args: argparse.Namespace, extra: list[str]) -> tuple[argparse.Namespace, l
     if len(extra) != 0:
         raise ArgumentError(f"Unknown arguments: {extra}")
 
-    if not op.exists(args.input):
-        raise ArgumentError("Input file does not exist")
+    if args.input == "-":
+        # Programs come from stdin and go to stdout, so there is no input file to check
+        if args.output:
+            raise ArgumentError("Input from stdin (-) is compiled to stdout. Redirect it rather than using -o")
+        if args.watch or args.checkpoint or args.resume:
+            raise ArgumentError("Input from stdin (-) cannot be used with --watch, --checkpoint or --resume")
+    else:
+        if not op.exists(args.input):
+            raise ArgumentError("Input file does not exist")
 
-    args.input = op.abspath(args.input)
+        args.input = op.abspath(args.input)
 
-    input_root, input_ext = op.splitext(args.input)
-    if input_ext != ".psll":
-        raise ArgumentError("Input file does not have .psll extension")
+        input_root, input_ext = op.splitext(args.input)
+        if input_ext != ".psll":
+            raise ArgumentError("Input file does not have .psll extension")
+
+        validate_output(args, input_root)
+
+    validate_search_options(args)
+    validate_checkpoint_options(args)
+    validate_objective_options(args)
+
+    if args.pareto and not args.output:
+        raise ArgumentError("Pareto front needs an output file (-o)")
+
+    if args.jobs is not None and args.jobs < 0:
+        raise ArgumentError("Number of jobs must not be negative")
+
+    if args.poll_interval <= 0:
+        raise ArgumentError("Poll interval must be positive")
+
+    if args.watch and (args.pareto or args.checkpoint or args.resume):
+        raise ArgumentError("--watch cannot be used with --pareto, --checkpoint or --resume")
+
+    if args.server:
+        if not op.exists(args.server):
+            raise ArgumentError(f"Server socket {args.server} does not exist. Start the server with psll serve")
+        if args.watch or args.pareto or args.checkpoint or args.resume:
+            raise ArgumentError("--server cannot be used with --watch, --pareto, --checkpoint or --resume")
+
+    return args, extra
+
+
+def validate_output(args: argparse.Namespace, input_root: str) -> None:
+    """Validate the -o and -f options, and resolve the default output filename"""
 
     if args.output == "":
         pass
@@ -208,8 +496,6 @@ def _(args: argparse.Namespace, extra: list[str]) -> tuple[argparse.Namespace, l
         if output_ext != ".pyra":
             raise ArgumentError("Output file does not have .pyra extension")
 
-    return args, extra
-
 
 # ======================================================================
 #
@@ -308,6 +594,8 @@ def check_ruby(ruby: str) -> str:
             raise ArgumentError(f"'{ruby}' is not a file.")
     else:
         # Check if ruby is in the PATH
+        import shutil
+
         found_ruby = shutil.which("ruby")
         if found_ruby is None:
             raise ArgumentError("Ruby executable not found. Please specify the path to the ruby executable.")
@@ -356,6 +644,129 @@ def _(args: argparse.Namespace, extra: list[str]) -> tuple[argparse.Namespace, l
     return args, extra
 
 
+# =======================================================================
+#
+#   ####    #####    ######  ####  ###    ###  ####   ####   #####
+#  ##  ##   ##  ##     ##     ##   ## #  # ##   ##   ##      ##
+#  ##  ##   #####      ##     ##   ##  ##  ##   ##    ###    #####
+#  ##  ##   ##         ##     ##   ##      ##   ##      ##   ##
+#   ####    ##         ##    ####  ##      ##  ####  ####    #####
+#
+# =======================================================================
+
+
+@register_add_subcommand(Subcommand.OPTIMISE)
+def _(subparsers: argparse._SubParsersAction) -> None:
+    """Add options to the optimise subcommand parser"""
+
+    optimise_parser = subparsers.add_parser(
+        "optimise",
+        help="re-optimise an already compiled pyramid scheme program",
+    )
+
+    optimise_parser.add_argument("input", help="Input pyramid scheme file, with the .pyra extension.")
+
+    optimise_parser.add_argument(
+        "-o",
+        dest="output",
+        required=False,
+        metavar="output",
+        nargs="?",
+        default="",
+        const=" ",
+        help=(
+            'Output pyramid scheme. If "output" is supplied, the optimised pyramid scheme is'
+            ' saved to that filename. If no "output" is supplied (aka just the -o'
+            " option) the input file is overwritten."
+        ),
+    )
+
+    optimise_parser.add_argument("-f", "--force", action="store_true", help="Force file overwrite.")
+
+    optimise_parser.add_argument(
+        "-go",
+        "--greedy-optimisation",
+        action="store_true",
+        help="Greedily insert empty pyramids. See the compile subcommand.",
+    )
+    optimise_parser.add_argument(
+        "-co",
+        "--considerate-optimisation",
+        action="store_true",
+        help=(
+            "Consider all the possible places to insert a pyramid. See the compile subcommand."
+            " This is the default if no optimisation is selected."
+        ),
+    )
+    optimise_parser.add_argument(
+        "-oo",
+        "--optimal",
+        action="store_true",
+        help="Group and wrap the pyramids with dynamic programming. See the compile subcommand.",
+    )
+    optimise_parser.add_argument(
+        "-bo",
+        "--beam-search",
+        action="store_true",
+        help="Keep several of the best candidates of each round. See the compile subcommand.",
+    )
+    optimise_parser.add_argument(
+        "-ao",
+        "--annealing",
+        action="store_true",
+        help="Make random changes to the pyramids by simulated annealing. See the compile subcommand.",
+    )
+    optimise_parser.add_argument(
+        "-so",
+        "--subtree-optimisation",
+        action="store_true",
+        help="Also regroup the statements in the bodies of the keywords. See the compile subcommand.",
+    )
+    add_search_arguments(optimise_parser)
+    add_checkpoint_arguments(optimise_parser)
+    add_objective_arguments(optimise_parser)
+    optimise_parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Print a progress line to stderr after each iteration. See the compile subcommand.",
+    )
+
+
+@register_validate_options(Subcommand.OPTIMISE)
+def _(args: argparse.Namespace, extra: list[str]) -> tuple[argparse.Namespace, list[str]]:
+    """Validate options for the optimise subcommand"""
+
+    if len(extra) != 0:
+        raise ArgumentError(f"Unknown arguments: {extra}")
+
+    if not op.exists(args.input):
+        raise ArgumentError("Input file does not exist")
+
+    args.input = op.abspath(args.input)
+
+    input_root, input_ext = op.splitext(args.input)
+    if input_ext != ".pyra":
+        raise ArgumentError("Input file does not have .pyra extension")
+
+    validate_output(args, input_root)
+    validate_search_options(args)
+    validate_checkpoint_options(args)
+    validate_objective_options(args)
+
+    # The subtree optimisation only works inside the top-level pyramids, so it does not count
+    top_level = (
+        args.greedy_optimisation,
+        args.considerate_optimisation,
+        args.optimal,
+        args.beam_search,
+        args.annealing,
+    )
+    if not any(top_level):
+        args.considerate_optimisation = True
+
+    return args, extra
+
+
 # ===============================================================================================================
 #
 #  #####    ####   ##    ##  ##   ##  ##      ####     ###    #####
@@ -418,6 +829,63 @@ def _(args: argparse.Namespace, extra: list[str]) -> tuple[argparse.Namespace, l
     return args, extra
 
 
+# ==============================================
+#
+#   ####   #####  #####    ##   ##  #####
+#  ##      ##     ##  ##   ##   ##  ##
+#   ###    #####  #####    ##   ##  #####
+#     ##   ##     ##  ##    ## ##   ##
+#  ####    #####  ##   ##    ###    #####
+#
+# ==============================================
+
+
+@register_add_subcommand(Subcommand.SERVE)
+def _(subparsers: argparse._SubParsersAction) -> None:
+    """Add options to the serve subcommand parser"""
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="run a compile server, which keeps its caches warm between compilations",
+    )
+
+    serve_parser.add_argument(
+        "--socket",
+        required=True,
+        metavar="PATH",
+        help="Unix socket to listen on. Compile with psll compile --server PATH.",
+    )
+
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of requests compiled at the same time. Default: 4.",
+    )
+
+    serve_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=128,
+        help="Number of compiled programs remembered, to answer repeated requests straight away. Default: 128.",
+    )
+
+
+@register_validate_options(Subcommand.SERVE)
+def _(args: argparse.Namespace, extra: list[str]) -> tuple[argparse.Namespace, list[str]]:
+    """Validate options for the serve subcommand"""
+
+    if len(extra) != 0:
+        raise ArgumentError(f"Unknown arguments: {extra}")
+
+    if args.workers < 1:
+        raise ArgumentError("Number of workers must be at least 1")
+
+    if args.cache_size < 0:
+        raise ArgumentError("Cache size must not be negative")
+
+    return args, extra
+
+
 def parse_args() -> tuple[argparse.Namespace, list[str]]:
     parser = argparse.ArgumentParser(
         description="Compile lisp-like syntax to Pyramid Scheme",
@@ -450,10 +918,10 @@ def parse_args() -> tuple[argparse.Namespace, list[str]]:
     args, extra = parser.parse_known_args()
 
     # Parse subcommand as Subcommand enum
-    args.subcommand = Subcommand(args.subcommand)
+    subcommand = args.subcommand = Subcommand(args.subcommand)
 
     # Dispatch to subcommand-specific validation
-    return args.subcommand.validate_options(args, extra)
+    return subcommand.validate_options(args, extra)
 
 
 # ======================================================================
@@ -466,19 +934,261 @@ def parse_args() -> tuple[argparse.Namespace, list[str]]:
 #
 # ======================================================================
 
-from . import (  # noqa: E402
-    build,
-    lexer,
-    macros,
-    optimisers,
-    preprocessor,
+
+def resume_optimisation(ast: tuple, args: argparse.Namespace) -> tuple[tuple, Optional["optimisers.checkpoint"]]:
+    """Swap the ast for the one saved in the checkpoint of the --resume option, if any, and make
+    sure the optimisation which saved it is run again"""
+    if not args.resume:
+        return ast, None
+
+    from . import optimisers
+
+    state = optimisers.load_checkpoint(args.resume)
+    if optimisers.statements(state.ast) != optimisers.statements(ast):
+        raise ArgumentError(f"Checkpoint {args.resume} is not a checkpoint of {args.input}")
+    setattr(args, f"{state.optimiser}_optimisation", True)
+    return state.ast, state
+
+
+def optional_macros(args: argparse.Namespace) -> tuple[str, ...]:
+    """Names of the opt-in macros selected in the options"""
+    from . import macros
+
+    return tuple(name for name in macros.__optional_macros__ if getattr(args, name, False))
+
+
+def print_progress(event: "optimisers.progress_event") -> None:
+    """Print a progress line of an optimiser to stderr"""
+    cache = "n/a" if event.cache_hit_rate is None else f"{100 * event.cache_hit_rate:.1f}%"
+    print(
+        f"{event.optimiser} | iteration {event.iteration} | best len {event.best_length}"
+        f" | {event.candidates} candidates ({event.candidates_per_second:.1f}/s)"
+        f" | cache hits {cache} | {event.iteration_time:.2f}s",
+        file=sys.stderr,
+    )
+
+
+def run_optimisers(
+    ast: tuple,
+    args: argparse.Namespace,
+    verbose: bool = True,
+    resume: Optional["optimisers.checkpoint"] = None,
+) -> tuple:
+    """Run all the optimisations selected in the options, from the slowest to the fastest"""
+    selected = (
+        args.subtree_optimisation,
+        args.optimal,
+        args.beam_search,
+        args.annealing,
+        args.considerate_optimisation,
+        args.greedy_optimisation,
+    )
+    if not any(selected):
+        return ast  # Don't even import the optimisers
+
+    from . import optimisers
+
+    checkpointer = None
+    if args.checkpoint:
+        checkpointer = optimisers.Checkpointer(args.checkpoint, args.checkpoint_every, args.checkpoint_seconds)
+    start_iter = lambda name: resume.iteration if resume and resume.optimiser == name else 0
+    progress = print_progress if args.progress else None
+    cost = None  # Just the length
+    if args.objective == "weighted":
+        cost = optimisers.weighted_cost(*args.weights)
+    elif args.objective != "bytes":
+        cost = optimisers.COSTS[args.objective]
+
+    # Regroup the bodies of the keywords first, so that the top-level optimisations see their final shape
+    if args.subtree_optimisation:
+        ast = optimisers.subtree_optimisation(ast, verbose=verbose)
+    # TODO  Make optimisation options mutually exclusive
+    if args.optimal:
+        ast = optimisers.optimal_optimisation(ast, verbose=verbose)
+    if args.beam_search:
+        ast = optimisers.beam_search_optimisation(
+            ast, beam_width=args.beam_width, time_budget=args.time_limit, verbose=verbose, cost=cost
+        )
+    if args.annealing:
+        ast = optimisers.annealing_optimisation(
+            ast, iterations=args.iterations, time_budget=args.time_limit, seed=args.seed, verbose=verbose
+        )
+    if args.considerate_optimisation:
+        ast = optimisers.considerate_optimisation(
+            ast,
+            verbose=verbose,
+            max_iter=None,
+            checkpointer=checkpointer,
+            start_iter=start_iter("considerate"),
+            progress=progress,
+            cost=cost,
+        )
+    if args.greedy_optimisation:
+        ast = optimisers.greedy_optimisation(
+            ast,
+            verbose=verbose,
+            max_iter=None,
+            checkpointer=checkpointer,
+            start_iter=start_iter("greedy"),
+            progress=progress,
+            cost=cost,
+        )
+    return ast
+
+
+def watch_and_compile(args: argparse.Namespace) -> None:
+    """Compile the input every time it changes, until interrupted. Errors are reported, and the
+    watching carries on, so that a half-finished edit does not need a restart."""
+    from . import compiler, preprocessor
+
+    just_filename = op.basename(args.input)
+    print(f"Watching {just_filename} for changes. Press Ctrl+C to stop.", file=sys.stderr)
+    session = compiler.CompileSession(full_names=args.full_names, optional=optional_macros(args))
+    try:
+        for _ in compiler.watch([args.input], interval=args.poll_interval):
+            start = time.perf_counter()
+            try:
+                ast = session.process(preprocessor.read_file(args.input))
+                ast = run_optimisers(ast, args, verbose=args.verbose > 1)
+                program = session.build(ast)
+            except Exception as e:
+                print(f"Error compiling {just_filename}: {e}", file=sys.stderr)
+                continue
+
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(program)
+            else:
+                print(program)
+
+            elapsed = 1000 * (time.perf_counter() - start)
+            print(
+                f"Compiled {just_filename} in {elapsed:.1f} ms"
+                f" ({session.processed} forms processed, {session.reused} reused)",
+                file=sys.stderr,
+            )
+    except KeyboardInterrupt:
+        pass
+
+
+# Options of the compile subcommand which are sent to the compile server
+SERVER_OPTIONS = (
+    "full_names",
+    "fold_constants",
+    "balance_strings",
+    "hoist_constants",
+    "eliminate_dead_stores",
+    "greedy_optimisation",
+    "considerate_optimisation",
+    "optimal",
+    "beam_search",
+    "annealing",
+    "subtree_optimisation",
+    "beam_width",
+    "time_limit",
+    "iterations",
+    "seed",
+    "objective",
+    "weights",
 )
 
 
+def compile_defaults() -> argparse.Namespace:
+    """Default options of the compile subcommand"""
+    parser = argparse.ArgumentParser()
+    Subcommand.COMPILE.add_subcommand(parser.add_subparsers(dest="subcommand"))
+    args, _ = parser.parse_known_args(["compile", ""])
+    return args
+
+
+def compile_on_server(args: argparse.Namespace, text: str) -> str:
+    """Compile the program with the server of the --server option"""
+    from . import server
+
+    options = {name: getattr(args, name) for name in SERVER_OPTIONS}
+    response = server.request(args.server, text, options)
+    if "error" in response:
+        raise RuntimeError(f"Compile server error: {response['error']}")
+    if args.verbose > 1:
+        cached = " (cached)" if response["cached"] else ""
+        print(f"Compiled on the server in {1000 * response['time']:.1f} ms{cached}")
+    program: str = response["program"]
+    return program
+
+
+def serve_optimise(ast: tuple, options: dict[str, Any]) -> tuple:
+    """Run the optimisations selected in the options of a compile server request"""
+    args = compile_defaults()
+    for name in SERVER_OPTIONS:
+        if name in options:
+            setattr(args, name, options[name])
+    validate_search_options(args)
+    if isinstance(args.weights, str):
+        validate_objective_options(args)
+    args.weights = tuple(args.weights)
+    return run_optimisers(ast, args, verbose=False)
+
+
+@register_subcommand(Subcommand.SERVE)
+def _(args: argparse.Namespace, extra: list[str]) -> None:
+    """Run the compile server until interrupted"""
+    from . import server
+
+    compile_server = server.CompileServer(
+        args.socket,
+        optimise=serve_optimise,
+        workers=args.workers,
+        cache_size=args.cache_size,
+    )
+    print(f"Serving on {args.socket} with {args.workers} workers. Press Ctrl+C to stop.", file=sys.stderr)
+    with suppress(KeyboardInterrupt):
+        compile_server.serve_forever()
+
+
+def compile_stream(args: argparse.Namespace) -> None:
+    """Compile the NUL-separated programs from stdin one by one, and stream each one to stdout as soon
+    as it is built. The outputs are separated with NUL characters too. A program which does not compile
+    is reported on stderr and gets an empty output, so the outputs still line up with the programs."""
+    from . import build, lexer, macros, preprocessor
+
+    for i, text in enumerate(preprocessor.read_programs(sys.stdin)):
+        if i:
+            sys.stdout.write("\0")
+        try:
+            if args.server:
+                program = compile_on_server(args, text)
+                pyra_lines, pyra_chars = len(program.splitlines()), sys.stdout.write(program)
+            else:
+                ast = lexer.lex(preprocessor.preprocess(text))
+                ast = macros.apply_processing_stack(ast, full_names=args.full_names, optional=optional_macros(args))
+                ast = run_optimisers(ast, args, verbose=False)  # Stdout is for the programs only
+                if not ast:
+                    raise ValueError("Empty program")
+                pyra_lines, pyra_chars = build.render_to(ast, sys.stdout, jobs=args.jobs)
+        except Exception as e:
+            print(f"program {i}: {type(e).__name__}: {e}", file=sys.stderr)
+            sys.stdout.flush()
+            continue
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+        if args.verbose:
+            print(f"program {i}: {pyra_lines} lines, {pyra_chars} characters", file=sys.stderr)
+
+
 @register_subcommand(Subcommand.COMPILE)
 def _(args: argparse.Namespace, extra: list[str]) -> None:
     """Main function for the command-line operation"""
 
+    if args.watch:
+        watch_and_compile(args)
+        return
+
+    if args.input == "-":
+        compile_stream(args)
+        return
+
+    from . import build, lexer, macros, preprocessor
+
     if args.verbose:
         just_filename = op.basename(args.input)
         print(f"Compiling {just_filename} to pyramid scheme")
@@ -494,32 +1204,90 @@ def _(args: argparse.Namespace, extra: list[str]) -> None:
     # Count lines and characters in the original source
     psll_lines, psll_chars = len(text.splitlines()), len(text)
 
-    text = preprocessor.preprocess(text)
-    if args.verbose > 2:
-        print("Reduced source:", text)
+    program = None
+    if args.server:
+        program = compile_on_server(args, text)
+    else:
+        text = preprocessor.preprocess(text)
+        if args.verbose > 2:
+            print("Reduced source:", text)
+
+        ast = lexer.lex(text)
+
+        # print(ast, end="\n\n")
+        # names = find_variable_names(ast)
+        # print('variables:',variables)
+
+        optional = optional_macros(args)
+        if args.verbose and args.eliminate_dead_stores:
+            # It is the last macro anyway. Run it on its own, to see what it removed
+            optional = tuple(name for name in optional if name != "eliminate_dead_stores")
+            ast = macros.apply_processing_stack(ast, full_names=args.full_names, optional=optional)
+            ast, removed = macros.remove_dead_stores(ast)
+            print(f"Dead store elimination removed {removed} pyramids")
+        else:
+            ast = macros.apply_processing_stack(ast, full_names=args.full_names, optional=optional)
+        # print(ast)
+        ast, resume = resume_optimisation(ast, args)
+        ast = run_optimisers(ast, args, resume=resume)
+
+    if program is None and args.output and args.verbose <= 2:
+        # Stream the program straight into the output file, row by row
+        with open(args.output, "w") as f:
+            pyra_lines, pyra_chars = build.render_to(ast, f, jobs=args.jobs)
+    else:
+        if program is None:
+            program = build.build(ast, jobs=args.jobs)
 
-    ast = lexer.lex(text)
+        # Count lines and characters in the generated pyramid scheme program
+        pyra_lines, pyra_chars = len(program.splitlines()), len(program)
 
-    # print(ast, end="\n\n")
-    # names = find_variable_names(ast)
-    # print('variables:',variables)
+        # Print the generated pyramid scheme program only in -vv mode
+        if args.verbose > 2:
+            print("Pyramid scheme:", program, sep="\n")
 
-    ast = macros.apply_processing_stack(ast, full_names=args.full_names)
-    # print(ast)
-    # TODO  Make optimisation options mutually exclusive
-    if args.considerate_optimisation:
-        ast = optimisers.considerate_optimisation(ast, max_iter=None)
-    if args.greedy_optimisation:
-        ast = optimisers.greedy_optimisation(ast, max_iter=None)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(program)
+        else:
+            print(program)
 
-    program = build.build(ast)
+    if args.verbose:
+        print("psll file:", psll_lines, "lines,", psll_chars, "characters")
+        print("pyra file:", pyra_lines, "lines,", pyra_chars, "characters")
+
+    if args.pareto:
+        from . import optimisers
+
+        output_root, _ = op.splitext(args.output)
+        front = optimisers.pareto_optimisation(ast, verbose=args.verbose > 0)
+        for i, (metrics, variant) in enumerate(front):
+            filename = f"{output_root}.pareto-{i}.pyra"
+            with open(filename, "w") as f:
+                build.render_to(variant, f)
+            print(f"{filename}: {metrics.bytes} bytes, {metrics.lines} lines, {metrics.width} wide")
+
+
+@register_subcommand(Subcommand.OPTIMISE)
+def _(args: argparse.Namespace, extra: list[str]) -> None:
+    """Parse a pyramid scheme program back into the ast, optimise it and build it again"""
+    from . import build, optimisers, parser, preprocessor
+
+    if args.verbose:
+        just_filename = op.basename(args.input)
+        print(f"Optimising {just_filename}")
+
+    old_program = preprocessor.read_file(args.input)
+    ast = parser.parse(old_program)
 
-    # Count lines and characters in the generated pyramid scheme program
-    pyra_lines, pyra_chars = len(program.splitlines()), len(program)
+    ast, resume = resume_optimisation(ast, args)
+    ast = run_optimisers(ast, args, verbose=args.verbose > 0, resume=resume)
 
-    # Print the generated pyramid scheme program only in -vv mode
-    if args.verbose > 2:
-        print("Pyramid scheme:", program, sep="\n")
+    program = build.build(ast)
+
+    # Make sure the optimised program still does the same thing
+    if optimisers.statements(parser.parse(program)) != optimisers.statements(parser.parse(old_program)):
+        raise RuntimeError("Optimised program is not equivalent to the original one. Not saving it.")
 
     if args.output:
         with open(args.output, "w") as f:
@@ -527,9 +1295,11 @@ def _(args: argparse.Namespace, extra: list[str]) -> None:
     else:
         print(program)
 
-    if args.verbose:
-        print("psll file:", psll_lines, "lines,", psll_chars, "characters")
-        print("pyra file:", pyra_lines, "lines,", pyra_chars, "characters")
+    old_chars, new_chars = len(old_program.rstrip("\n")), len(program)
+    if args.output or args.verbose:
+        saved = old_chars - new_chars
+        percent = 100 * saved / old_chars if old_chars else 0
+        print(f"pyra file: {old_chars} -> {new_chars} characters (saved {saved}, {percent:.1f}%)")
 
 
 # PYRA_RB_URL = "https://raw.github.com/ConorOBrien-Foxx/Pyramid-Scheme/blob/fd183d296f08e0cba8bf55da907697eaf412f6a7/pyra.rb"
@@ -541,6 +1311,8 @@ EXPECTED_HASH = "a2b8175e8807cf5acce35c73252994dd"
 
 def find_pyra_rb(verbose: int) -> Optional[str]:
     """Find the pyramid scheme interpreter"""
+    import hashlib
+
     candidates: list[str] = []
 
     # Check rhe current working directory for pyra.rb
@@ -588,6 +1360,7 @@ def find_pyra_rb(verbose: int) -> Optional[str]:
 @register_subcommand(Subcommand.RUN)
 def _(args: argparse.Namespace, extra: list[str]) -> None:
     """Main function for the command-line operation"""
+    import subprocess
 
     if args.verbose > 1:
         print("Ruby executable:", args.ruby)
@@ -610,6 +1383,7 @@ def _(args: argparse.Namespace, extra: list[str]) -> None:
 @register_subcommand(Subcommand.COMPILE_AND_RUN)
 def _(args: argparse.Namespace, extra: list[str]) -> None:
     """Main function for the command-line operation"""
+    import tempfile
 
     # Get a temporary directory
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -618,17 +1392,22 @@ def _(args: argparse.Namespace, extra: list[str]) -> None:
         if args.verbose > 1:
             print("Temporary output file:", temp_output)
 
-        args.output = temp_output
+        # This is just a convenience function to run the psll code, so compile it with the defaults
+        from . import compiler, preprocessor
+
+        text = preprocessor.read_file(args.input)
+        result = compiler.compile_source(text)
+        with open(temp_output, "w") as f:
+            f.write(result.program)
 
-        # We don't care about these options for the compile step
-        # This is just a convenience function to run the psll code
-        args.full_names = False
-        args.considerate_optimisation = False
-        args.greedy_optimisation = False
-        Subcommand.COMPILE.run(args, extra)
+        if args.verbose:
+            elapsed = 1000 * sum(result.timings.values())
+            print(f"Compiled {op.basename(args.input)} to pyramid scheme in {elapsed:.1f} ms")
+            print("psll file:", len(text.splitlines()), "lines,", len(text), "characters")
+            print("pyra file:", result.metrics.lines, "lines,", result.metrics.bytes, "characters")
 
         # Run
-        args.input = args.output
+        args.input = temp_output
         Subcommand.RUN.run(args, extra)
 
 
@@ -695,6 +1474,9 @@ def _(args: argparse.Namespace, extra: list[str]) -> None:
         if args.verbose > 1:
             print("Found a suitable directory to write to:", write_dir)
 
+    import hashlib
+    import shutil
+    import tempfile
     import urllib.request
 
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -16,10 +16,21 @@ if TYPE_CHECKING:
 
 
 # from typing import final
+import sys
 from abc import ABC, abstractmethod
-from itertools import islice, zip_longest
+from itertools import islice, tee, zip_longest
+
+if sys.version_info >= (3, 10):
+    from itertools import pairwise
+else:
+    _T = TypeVar("_T")
+
+    def pairwise(iterable: Iterable[_T]) -> Iterator[tuple[_T, _T]]:
+        """``itertools.pairwise`` of Python 3.10+. (more_itertools has it too, but it is much slower to import)"""
+        a, b = tee(iterable)
+        next(b, None)
+        return zip(a, b)
 
-from more_itertools import pairwise
 
 # ======================================================================================================================
 #
@@ -112,13 +123,12 @@ class AbstractTree(ABC):
     def string2grid(string: str) -> list[row_tuple]:
         grid = []
         for row in string.split("\n"):
-            i1, i2 = 0, len(row)
-            for i, (l1, l2) in enumerate(pairwise(row)):
-                if l1 == SPACE and l2 != SPACE and not i1:
-                    i1 = i + 1
-                if l1 != SPACE and l2 == SPACE:
-                    i2 = i + 1
-            grid.append(row_tuple(i1, row[i1:i2], len(row) - i2))
+            center = row.strip(SPACE)
+            if not center:  # Blank row
+                grid.append(row_tuple(0, row, 0))
+                continue
+            i1 = len(row) - len(row.lstrip(SPACE))
+            grid.append(row_tuple(i1, center, len(row) - i1 - len(center)))
         return grid
 
     def __init__(self, grid: Iterable[row_tuple | tuple[int, str, int]]):
@@ -1,9 +1,11 @@
 import operator
+import os
 import sys
+from collections.abc import Iterable, Iterator
 from functools import lru_cache, reduce, singledispatch
-from typing import Union, overload
+from typing import NamedTuple, Optional, TextIO, Union, overload
 
-from .ascii_trees import AbstractTree, Pyramid
+from .ascii_trees import BOTTOM, SPACE, TOP, AbstractTree, Pyramid, Tree
 
 if sys.version_info >= (3, 14):
     # Fix for lru_cache in Python 3.14+
@@ -79,8 +81,131 @@ def build_tree(ast: Union[str, tuple, None]) -> Union[AbstractTree, None]:
     return _build_tree(ast)
 
 
-def build(ast: tuple) -> str:
-    """Build the program from the abstract syntax tree"""
-    program = str(reduce(operator.add, (build_tree(a) for a in ast)))
-    # Remove excessive whitespace
-    return "\n".join(line[1:].rstrip() for line in program.split("\n"))
+def cache_info() -> Optional[tuple[int, int]]:
+    """Hits and misses of the cache of the built trees, or None if the trees are not cached"""
+    info = getattr(_build_tree.registry[tuple], "cache_info", None)
+    if info is None:
+        return None
+    hits, misses, *_ = info()
+    return hits, misses
+
+
+def _build_grid(ast: Union[str, tuple]) -> tuple[tuple[int, str, int], ...]:
+    """Build a single top-level tree in a worker process, and send back just its rows"""
+    tree = build_tree(ast)
+    assert tree is not None, "Top-level trees are never empty"
+    return tuple((left, center, right) for left, center, right in tree)
+
+
+def build_trees(ast: tuple, jobs: Optional[int] = None) -> Iterable[AbstractTree]:
+    """Build all the top-level trees. With ``jobs`` > 1, they are built in that many worker processes
+    (all the cpus for ``jobs`` = 0), since they are independent of each other until they are put
+    side-by-side. The workers only send back the rows of the trees."""
+    if jobs == 1 or jobs is None or len(ast) < 2:
+        return (build_tree(a) for a in ast)
+
+    from concurrent.futures import ProcessPoolExecutor  # Slow to import, and only needed here
+
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(jobs) as pool:
+        chunksize = max(len(ast) // (4 * jobs), 1)
+        return [Tree(grid) for grid in pool.map(_build_grid, ast, chunksize=chunksize)]
+
+
+def build_program_tree(ast: tuple, left: Optional[AbstractTree] = None, jobs: Optional[int] = None) -> AbstractTree:
+    """Build all the top-level trees and put them side-by-side (to the right of ``left``, if given)"""
+    trees = build_trees(ast, jobs)
+    return reduce(operator.add, trees) if left is None else reduce(operator.add, trees, left)
+
+
+def program_rows(tree: AbstractTree) -> Iterator[str]:
+    """Yield the rows of the program, without the leading column and the trailing whitespace"""
+    for left, center, _ in tree:
+        # Right padding is dropped by the rstrip anyway, so don't build it
+        yield (SPACE * left + center)[1:].rstrip()
+
+
+def program_length(tree: AbstractTree) -> int:
+    """Length of the program built from the tree, without building it"""
+    return sum(len(row) for row in program_rows(tree)) + tree.height - 1
+
+
+_TOUCHING = {(TOP, BOTTOM), (BOTTOM, TOP)}
+
+
+class Contour:
+    """Right-hand edge of a program: the end and the last character of each of its rows, and the start of
+    its leftmost row. This is all that is needed to put more trees to its right, and to tell its length."""
+
+    def __init__(self) -> None:
+        self.ends: list[int] = []  # End of each row of the program so far
+        self.lasts: list[str] = []  # Last character of each row of the program so far
+        self.min_start = 0
+
+    def copy(self) -> "Contour":
+        other = Contour()
+        other.ends, other.lasts, other.min_start = self.ends.copy(), self.lasts.copy(), self.min_start
+        return other
+
+    def add(self, tree: AbstractTree) -> None:
+        """Place the tree as far to the left as its rows allow, just like ``Tree.add_side_by_side`` does"""
+        ends, lasts = self.ends, self.lasts
+        offset = 0
+        if ends:
+            # Rows which touch tip-to-base need an extra space between them
+            offset = max(
+                end + ((last, row.center[0]) in _TOUCHING) - row.left for end, last, row in zip(ends, lasts, tree)
+            )
+        else:
+            self.min_start = tree[0].left
+        for r, (left, center, _) in enumerate(tree):
+            start = offset + left
+            self.min_start = min(self.min_start, start)
+            if r < len(ends):
+                ends[r], lasts[r] = start + len(center), center[-1]
+            else:
+                ends.append(start + len(center))
+                lasts.append(center[-1])
+
+    def length(self) -> int:
+        """Length of the program, as ``program_length`` would give it"""
+        return sum(self.ends) - self.min_start * len(self.ends) + len(self.ends) - 1
+
+
+def program_length_of_trees(trees: Iterable[AbstractTree], contour: Optional[Contour] = None) -> int:
+    """Length of the program made out of ``trees`` (to the right of ``contour``, if given), from the
+    extents of their rows alone. This is exact, like ``program_length``, but it never puts the text of
+    the trees together. See ``Contour``."""
+    contour = Contour() if contour is None else contour.copy()
+    for tree in trees:
+        contour.add(tree)
+    return contour.length()
+
+
+class program_metrics(NamedTuple):
+    bytes: int  # Length of the program, newlines included
+    lines: int
+    width: int  # Length of the longest line
+
+
+def metrics(tree: AbstractTree) -> program_metrics:
+    """Size of the program built from the tree, without building it"""
+    lengths = [len(row) for row in program_rows(tree)]
+    return program_metrics(sum(lengths) + len(lengths) - 1, len(lengths), max(lengths))
+
+
+def build(ast: tuple, jobs: Optional[int] = None) -> str:
+    """Build the program from the abstract syntax tree. See ``build_trees`` for ``jobs``."""
+    return "\n".join(program_rows(build_program_tree(ast, jobs=jobs)))
+
+
+def render_to(ast: tuple, fileobj: TextIO, jobs: Optional[int] = None) -> tuple[int, int]:
+    """Build the program from the abstract syntax tree and write it to ``fileobj`` row by row.
+    Returns the number of lines and characters written."""
+    lines, chars = 0, 0
+    for row in program_rows(build_program_tree(ast, jobs=jobs)):
+        if lines:
+            chars += fileobj.write("\n")
+        chars += fileobj.write(row)
+        lines += 1
+    return lines, chars
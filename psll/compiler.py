@@ -0,0 +1,196 @@
+"""
+In-process compilation of psll source, and compile sessions, which compile successive versions of the
+same program (for example, as it is being edited) and reuse all the work done for the top-level forms
+which did not change.
+"""
+
+from __future__ import annotations
+
+import operator
+import os
+import time
+from collections.abc import Iterable, Iterator
+from functools import partial, reduce
+from typing import Callable, NamedTuple
+
+from . import PsllSyntaxError, build, lexer, macros, preprocessor
+from .ascii_trees import AbstractTree
+
+
+class CompileResult(NamedTuple):
+    program: str
+    ast: tuple  # After the processing stack and the optimisation
+    metrics: build.program_metrics
+    timings: dict[str, float]  # Seconds spent in each stage: preprocess, lex, macros, optimise and build
+
+
+def optimiser_function(name: str) -> Callable[[tuple], tuple]:
+    """Optimisation of the given name, with the default settings, which does not print anything"""
+    from . import optimisers  # Not needed unless optimising
+
+    functions: dict[str, Callable[..., tuple]] = {
+        "greedy": optimisers.greedy_optimisation,
+        "considerate": optimisers.considerate_optimisation,
+        "optimal": optimisers.optimal_optimisation,
+        "beam-search": optimisers.beam_search_optimisation,
+        "annealing": optimisers.annealing_optimisation,
+        "subtree": optimisers.subtree_optimisation,
+    }
+    if name not in functions:
+        raise ValueError(f"Unknown optimiser {name!r}. Expected one of: {', '.join(functions)}")
+    return partial(functions[name], verbose=False)
+
+
+def compile_source(
+    text: str,
+    *,
+    full_names: bool = False,
+    optimiser: str | Callable[[tuple], tuple] | None = None,
+    optional: Iterable[str] = (),
+) -> CompileResult:
+    """Compile the psll source into pyramid scheme, in-process. ``optimiser`` is either the name of
+    one of the optimisations (see ``optimiser_function``), or a function from the ast to the optimised
+    ast. ``optional`` are the names of the opt-in macros to apply, such as "fold_constants". Nothing
+    is shared between the calls except the (thread-safe) cache of the built trees, so this can be
+    called from several threads at once."""
+    timings: dict[str, float] = {}
+    clock = time.perf_counter()
+
+    def lap(stage: str) -> None:
+        nonlocal clock
+        now = time.perf_counter()
+        timings[stage], clock = now - clock, now
+
+    text = preprocessor.preprocess(text)
+    lap("preprocess")
+    ast = lexer.lex(text)
+    if not ast:
+        raise PsllSyntaxError("Empty program. There is nothing to compile.")
+    lap("lex")
+    ast = macros.apply_processing_stack(ast, full_names=full_names, optional=optional)
+    lap("macros")
+    if optimiser is not None:
+        ast = (optimiser_function(optimiser) if isinstance(optimiser, str) else optimiser)(ast)
+    lap("optimise")
+    rows = list(build.program_rows(build.build_program_tree(ast)))
+    program = "\n".join(rows)
+    lap("build")
+
+    metrics = build.program_metrics(len(program), len(rows), max(map(len, rows)))
+    return CompileResult(program, ast, metrics, timings)
+
+
+class form_key(NamedTuple):
+    form: macros.Node  # Top-level form, with the variable names already shortened
+    defs: tuple[tuple[str, tuple], ...]  # Defs in scope at the start of the form, of the names used in it
+    depth: int  # Number of all the defs in scope at the start of the form
+
+
+class processed_form(NamedTuple):
+    node: macros.Node  # Top-level form after the whole processing stack
+    popped: int  # Number of defs the form took off the stack...
+    pushed: tuple[tuple[str, tuple], ...]  # ...and the ones it put on it
+
+
+def leaves(form: macros.Node) -> set[str]:
+    """All the strings in the form"""
+    if form is None:
+        return set()
+    if isinstance(form, str):
+        return {form}
+    return set().union(*(leaves(node) for node in form))
+
+
+class CompileSession:
+    """Compiles successive versions of the same program. The processed top-level forms of the last
+    compilation are remembered, and a form is only processed again if its text changed (after the
+    variable names are shortened), or if any of the defs it uses changed. The built trees of the
+    top-level forms are remembered too. The whole-program macros are applied to all the forms, every time."""
+
+    def __init__(self, full_names: bool = False, optional: Iterable[str] = ()):
+        self.full_names = full_names
+        self.optional = tuple(optional)  # Opt-in macros
+        self._forms: dict[form_key, processed_form] = {}
+        self._trees: dict[macros.Node, AbstractTree] = {}
+        self.reused, self.processed = 0, 0  # Statistics of the last compilation
+
+    def process(self, text: str) -> tuple:
+        """Preprocess, lex and apply the processing stack to the source. Same as running them on the
+        whole source, but only the changed forms are processed."""
+        forms = lexer.lex(preprocessor.preprocess(text))
+        rules = {} if self.full_names else macros.shortening_rules(forms)
+        per_form = [name for name in self.optional if name not in macros.__whole_program_macros__]
+        stack = macros.processing_stack(optional=per_form)[2:]  # Everything after the names and the defs
+
+        cache, self._forms = self._forms, {}
+        self.reused, self.processed = 0, 0
+        defs: list[tuple[str, tuple]] = []
+        ast = []
+        for form in forms:
+            (form,) = macros.apply_shortening_rules((form,), rules)
+            names = leaves(form)
+            key = form_key(form, tuple(d for d in defs if d[0] in names), len(defs))
+            if key in cache:
+                self.reused += 1
+                result = cache[key]
+            else:
+                self.processed += 1
+                new_defs = list(defs)
+                node = macros.def_keyword_form(form, new_defs)
+                (node,) = reduce(lambda ast, macro: macro(ast), stack, (node,))
+                same = [a == b for a, b in zip(defs, new_defs)]
+                common = same.index(False) if False in same else len(same)
+                result = processed_form(node, len(defs) - common, tuple(new_defs[common:]))
+            self._forms[key] = result
+            defs = defs[: len(defs) - result.popped] + list(result.pushed)
+            ast.append(result.node)
+        for name in self.optional:
+            if name in macros.__whole_program_macros__:  # These always run last
+                macro, _ = macros.__optional_macros__[name]
+                ast = list(macro(tuple(ast)))
+        return tuple(ast)
+
+    def build(self, ast: tuple) -> str:
+        """Build the program, reusing the trees of the top-level forms of the last build"""
+        if not ast:
+            raise PsllSyntaxError("Empty program. There is nothing to compile.")
+        cache, self._trees = self._trees, {}
+        for node in ast:
+            self._trees[node] = cache[node] if node in cache else build.build_tree(node)
+        tree = reduce(operator.add, (self._trees[node] for node in ast))
+        return "\n".join(build.program_rows(tree))
+
+    def compile(self, text: str) -> str:
+        """Compile the source into pyramid scheme"""
+        return self.build(self.process(text))
+
+
+def file_stamp(path: str) -> tuple[int, int] | None:
+    """Modification time and size of the file, or None if it does not exist (yet)"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def watch(
+    paths: list[str],
+    interval: float = 0.5,
+    sleep: Callable[[float], None] = time.sleep,
+) -> Iterator[list[str]]:
+    """Poll the files every ``interval`` seconds, and yield the list of the ones which changed. All of
+    them are yielded straight away. A file which is missing (for example, in the middle of being saved
+    by an editor) is not considered changed until it appears again."""
+    stamps = {path: file_stamp(path) for path in paths}
+    yield list(paths)
+    while True:
+        sleep(interval)
+        changed = []
+        for path in paths:
+            stamp = file_stamp(path)
+            if stamp is not None and stamp != stamps[path]:
+                changed.append(path)
+            stamps[path] = stamp
+        if changed:
+            yield changed
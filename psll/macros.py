@@ -1,7 +1,8 @@
 # spell-checker: words replacer, lengther
 from __future__ import annotations
 
-from collections.abc import Generator, Iterable
+from collections import Counter
+from collections.abc import Generator, Iterable, Iterator, Mapping, Sequence
 from typing import (
     TYPE_CHECKING,
     Callable,
@@ -23,12 +24,15 @@ else:
     dyn_option = Optional
     dyn_union = Union
 
+import math
+import operator
+import re
 from functools import partial, reduce, singledispatch
+from itertools import zip_longest
 from string import ascii_letters
 
-from more_itertools import windowed
-
 from . import PsllSyntaxError, lexer
+from .optimisers import STATEMENT_KEYWORDS
 
 
 def in_pairs(
@@ -39,7 +43,8 @@ def in_pairs(
     If the iterable has an odd number of elements, `in_tuple` determines if the
     last element is a tuple or not.
     """
-    for one, two in windowed(iterable, 2, step=2):
+    it = iter(iterable)
+    for one, two in zip_longest(it, it):  # Same as more_itertools.windowed(iterable, 2, step=2)
         assert one is not None, "The iterable must not contain None"
         if two is not None:
             yield (one, two)
@@ -189,6 +194,23 @@ def in_processing_stack(fun: _T_Macro) -> _T_Macro:
     return fun
 
 
+__optional_macros__: dict[str, tuple[Macro, Macro]] = {}  # Opt-in macros, and the macro they run after
+__whole_program_macros__: set[str] = set()  # Opt-in macros which can't be applied to one top-level form at a time
+
+
+def optional_macro(name: str, after: Macro, whole_program: bool = False) -> Callable[[_T_Macro], _T_Macro]:
+    """Register an opt-in macro under ``name``. When selected, it runs straight after ``after``.
+    ``whole_program`` macros need to see all the top-level forms at once."""
+
+    def decorator(fun: _T_Macro) -> _T_Macro:
+        __optional_macros__[name] = (fun, after)
+        if whole_program:
+            __whole_program_macros__.add(name)
+        return fun
+
+    return decorator
+
+
 # ======================================================================================================================
 #
 #   ####  ##   ##   #####   #####    ######  #####  ##     ##        ##     ##    ###    ###    ###  #####   ####
@@ -212,9 +234,19 @@ def find_variable_names(ast: tuple) -> set[str]:
     return names
 
 
-@in_processing_stack
-def shorten_variable_names(ast: tuple) -> tuple:
-    """Shorten variable names to single letter, is possible"""
+def short_name(taken: set[str], name: str = "") -> str | None:
+    """Single letter name which is not taken. Letters of ``name`` are preferred, if there are any free."""
+    for letter in name:
+        if letter not in taken:
+            return letter
+    for letter in ascii_letters:  # All single letters in the name already used
+        if letter not in taken:
+            return letter
+    return None  # All single letter names already taken
+
+
+def shortening_rules(ast: tuple) -> dict[str, str]:
+    """Work out the short name of each variable"""
     names = find_variable_names(ast)
     future_names = set(n for n in names if len(n) == 1)
     rules: dict[str, str] = {}
@@ -222,28 +254,25 @@ def shorten_variable_names(ast: tuple) -> tuple:
         if len(name) == 1:  # Name is already short
             rules[name] = name
         else:
-            all_names = names.union(future_names)
-            for letter in name:
-                if letter not in all_names:
-                    rules[name] = letter
-                    future_names.add(letter)
-                    break  # Go to the next name
-            else:  # No break, aka all single letters in the variable name already used
-                for letter in ascii_letters:
-                    if letter not in all_names:
-                        rules[name] = letter
-                        future_names.add(letter)
-                        break  # Go to the next name
-                else:  # No break, aka all single letter names already taken
-                    # Give up and don't shorten the name
-                    rules[name] = name
-                    future_names.add(name)
+            # Give up and don't shorten the name if all single letter names are taken
+            rules[name] = short_name(names.union(future_names), name) or name
+            future_names.add(rules[name])
+    return rules
+
+
+def apply_shortening_rules(ast: tuple, rules: dict[str, str]) -> tuple:
+    """Replace variable names with shorter ones"""
 
     def string_replacer(node: str) -> str:
-        """Replace variable names with shorter ones"""
         return rules.get(node, node)
 
-    return tree_traversal(ast, str_fun=string_replacer)
+    return cast(tuple, tree_traversal(ast, str_fun=string_replacer))
+
+
+@in_processing_stack
+def shorten_variable_names(ast: tuple) -> tuple:
+    """Shorten variable names to single letter, is possible"""
+    return apply_shortening_rules(ast, shortening_rules(ast))
 
 
 # ======================================================================================================================
@@ -257,7 +286,7 @@ def shorten_variable_names(ast: tuple) -> tuple:
 # ======================================================================================================================
 
 
-def apply_replacement_rules(ast: tuple, rules: dict[str, tuple]) -> tuple:
+def apply_replacement_rules(ast: tuple, rules: Mapping[str, tuple]) -> tuple:
     """Apply replacement rules to the abstract syntax tree"""
 
     def singleton_tuple_replacer(node: tuple) -> tuple:  # Replace (f) by def of f
@@ -271,18 +300,44 @@ def apply_replacement_rules(ast: tuple, rules: dict[str, tuple]) -> tuple:
     return cast(tuple, ast2)
 
 
-@in_processing_stack
-def def_keyword(ast: tuple) -> tuple:
-    """Search for ('def','something',(...)) keywords"""
+class SymbolTable(Mapping[str, tuple]):
+    """Stack of the defs in scope, kept in the list ``defs`` (oldest first), with the definition of
+    each name looked up in O(1). A def shadows the ones of the same name under it, until it is popped."""
+
+    def __init__(self, defs: list[tuple[str, tuple]]):
+        self.defs = defs
+        self._scopes: dict[str, list[tuple]] = {}  # Definitions of each name, innermost last
+        for name, definition in defs:
+            self._scopes.setdefault(name, []).append(definition)
+
+    def push(self, name: str, definition: tuple) -> None:
+        self.defs.append((name, definition))
+        self._scopes.setdefault(name, []).append(definition)
+
+    def pop(self) -> tuple[str, tuple]:
+        name, definition = self.defs.pop()
+        scope = self._scopes[name]
+        scope.pop()
+        if not scope:
+            del self._scopes[name]
+        return name, definition
+
+    def __getitem__(self, name: str) -> tuple:
+        return self._scopes[name][-1]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._scopes)
+
+    def __len__(self) -> int:
+        return len(self._scopes)
+
 
-    defs: list[tuple[str, tuple]] = []
+def def_keyword_functions(defs: list[tuple[str, tuple]]) -> tuple[StrFun, PreFun, FinalFun]:
+    """Functions for the tree traversal of ``def_keyword``, which keep the stack of the defs in ``defs``"""
+    table = SymbolTable(defs)
 
     def replacer(node: str) -> tuple | str:
-        if len(defs) > 0:
-            for value, definition in reversed(defs):
-                if node == value:
-                    return definition
-        return node
+        return table.get(node, node)
 
     def find_defs(node: tuple) -> tuple:
         if len(node) > 0 and node[0] == "def":
@@ -297,17 +352,38 @@ def def_keyword(ast: tuple) -> tuple:
                 raise PsllSyntaxError(
                     f"'def' statement can only assign keys to brackets. Got type {type(value)} for bracket"
                 )
-            defs.append((key, apply_replacement_rules(value, dict(defs))))
+            table.push(key, apply_replacement_rules(value, table))
             return ()  # Return empty tuple
         return node
 
     def pop_def_stack(ast: tuple) -> tuple:
         for node in ast:
             if node == () and len(defs) > 0:
-                defs.pop()
+                table.pop()
         return ast
 
-    return tree_traversal(ast, str_fun=replacer, pre_fun=find_defs, final_fun=pop_def_stack)
+    return replacer, find_defs, pop_def_stack
+
+
+@in_processing_stack
+def def_keyword(ast: tuple) -> tuple:
+    """Search for ('def','something',(...)) keywords"""
+    replacer, find_defs, pop_def_stack = def_keyword_functions([])
+    return cast(tuple, tree_traversal(ast, str_fun=replacer, pre_fun=find_defs, final_fun=pop_def_stack))
+
+
+def def_keyword_form(form: Node, defs: list[tuple[str, tuple]]) -> Node:
+    """Same as ``def_keyword``, but for a single top-level form, given the ``defs`` made by all the
+    previous ones. Defs made by this form at the top level are pushed onto ``defs``."""
+    replacer, find_defs, pop_def_stack = def_keyword_functions(defs)
+    # Do what the traversal of the whole ast does for each of its nodes, but without popping the
+    # top-level defs at the end. Those are in scope until the end of the program.
+    if isinstance(form, str):
+        return replacer(form)
+    if isinstance(form, tuple):
+        form = find_defs(form)
+        return tree_traversal(form, str_fun=replacer, pre_fun=find_defs, final_fun=pop_def_stack)
+    return form
 
 
 # =======================================================================================
@@ -331,7 +407,7 @@ def range_keyword(ast: tuple) -> tuple:
                 raise PsllSyntaxError("'range' must be of the form (range begin end) or (range begin end step)")
             start, stop = int(node[1]), int(node[2]) + 1
             step = int(node[3]) if len(node) == 4 else 1
-            return ("[" + ", ".join(map(str, range(start, stop, step))) + "]",)
+            return (array_tree([str(i) for i in range(start, stop, step)]),)
         return node
 
     return tree_traversal(ast, pre_fun=ranger)
@@ -352,34 +428,63 @@ def range_keyword(ast: tuple) -> tuple:
 #     return tree_traversal(ast,pre_fun=lengther)
 
 
+ARRAY_CHAIN = 16  # Arrays of up to this many parts are a single chain
+MAX_CHAIN = 64  # Longer chains get too deep for the recursion of the tree traversals
+
+_ARRAY_SPECIAL = re.compile(r'["()\[\]\\]')  # Characters which need the context-sensitive split
+
+
+def balanced_chain(operands: Sequence[Node], op: str) -> Node:
+    """Balanced binary tree of the operation ``op`` over the operands, in the same order"""
+    if len(operands) == 1:
+        return operands[0]
+    middle = (len(operands) + 1) // 2
+    return (op, balanced_chain(operands[:middle], op), balanced_chain(operands[middle:], op))
+
+
+def chain_size(n: int, shortest: int = 2) -> int:
+    """Length of the chains of a balanced tree of chains over ``n`` operands. About twice the square
+    root of ``n`` keeps the rendered program small."""
+    return min(max(round(2 * math.sqrt(n)), shortest), MAX_CHAIN)
+
+
+def one_element_array(element: str) -> tuple:
+    """Put `element` into a one-element array with the subtraction trick"""
+    return ("-", (element, "0"), ("0", "0")) if element != "0" else ("-", (element, "1"), ("1", "1"))
+
+
+def array_tree(elements: list[str]) -> tuple:
+    """Ast tree of the array of the elements. The elements are put into arrays in pairs (and the last
+    one on its own if there is an odd number of them), and those arrays are concatenated. Short arrays
+    are a single right-deep chain of the concatenations. Long arrays (such as big ranges) would make
+    the chain too deep to process, so they are a balanced tree of short chains instead, like the
+    balanced strings."""
+    if not elements:
+        return ("-", ("0", "0"), ("0", "0"))  # Empty array
+
+    parts: list[tuple] = list(zip(elements[0::2], elements[1::2]))
+    if len(elements) % 2:
+        parts.append(one_element_array(elements[-1]))
+
+    def right_chain(parts: list[tuple]) -> tuple:
+        return reduce(lambda tree, part: ("+", part, tree), reversed(parts[:-1]), parts[-1])
+
+    size = chain_size(len(parts), shortest=ARRAY_CHAIN)
+    chains = [right_chain(parts[i : i + size]) for i in range(0, len(parts), size)]
+    return cast(tuple, balanced_chain(chains, "+"))
+
+
 # TESTED
 @in_processing_stack
 def expand_array_literals(ast: tuple) -> tuple:
-    def one_element_array(element: str) -> tuple:
-        """Put `element` into a one-element array with the subtraction trick"""
-        return ("-", (element, "0"), ("0", "0")) if element != "0" else ("-", (element, "1"), ("1", "1"))
-
-    def array_to_tree(string: str) -> tuple:
-        """Parse (inner) array string to its ast tree representation"""
-        elements = lexer.split(string)  # Reuse lexer split
-        if not elements:
-            return ("-", ("0", "0"), ("0", "0"))  # Return empty array
-
-        # Build the tree
-        if len(elements) % 2:
-            tree = one_element_array(elements[-1])
-            elements = elements[:-1]
-        else:
-            tree = ()
-        if elements:
-            for e2, e1 in windowed(reversed(elements), 2, step=2):
-                tree = ("+", (e1, e2), tree) if tree else (e1, e2)
-
-        return tree
-
     def array_expander(string: str) -> tuple | str:
         if lexer.in_context(string, "[]"):
-            return array_to_tree(string[1:-1])
+            inner = string[1:-1]
+            if _ARRAY_SPECIAL.search(inner):
+                elements = list(lexer.split(inner))  # Reuse lexer split
+            else:  # Just numbers and names
+                elements = [element for element in inner.split(" ") if element]
+            return array_tree(elements)
         return string
 
     return tree_traversal(ast, str_fun=array_expander)
@@ -397,22 +502,31 @@ def expand_array_literals(ast: tuple) -> tuple:
 
 
 # TESTED
-@in_processing_stack
-def expand_string_literals(ast: tuple) -> tuple:
-    string_split = partial(lexer.context_split, delimiter="", contexts=('""',), remove_empty=True)
+_string_split = partial(lexer.context_split, delimiter="", contexts=('""',), remove_empty=True)
+
+
+def string_characters(string: str) -> list[tuple]:
+    """The pyramids which make each of the characters of the (unquoted) string literal"""
 
     def special(char: str) -> str:
         """Convert char to its special character representation"""
         cases = {"n": "\n", "t": "\t", "r": "\r"}
         return cases.get(char, char)
 
+    characters = []
+    for char in _string_split(string):
+        if len(char) > 1 and char[0] == "\\":
+            char = special(char[1])
+        characters.append(("chr", "_", str(ord(char))))
+    return characters
+
+
+@in_processing_stack
+def expand_string_literals(ast: tuple) -> tuple:
     def expand(string: str) -> tuple | str:
         if lexer.in_context(string, '""'):
             tree: tuple = ()
-            for char in string_split(string[1:-1]):
-                if len(char) > 1 and char[0] == "\\":
-                    char = special(char[1])
-                subtree = ("chr", "_", str(ord(char)))
+            for subtree in string_characters(string[1:-1]):
                 tree = subtree if not tree else ("+", tree, subtree)
             # TODO Is there a more robust way of making an empty string in pyramid scheme??
             if not tree:
@@ -423,6 +537,36 @@ def expand_string_literals(ast: tuple) -> tuple:
     return tree_traversal(ast, str_fun=expand)
 
 
+def left_chain(operands: list, op: str) -> Node:
+    """Left-deep chain of the operation ``op`` over the operands, like the one of the string expansion"""
+    tree: Node = operands[0]
+    for operand in operands[1:]:
+        tree = (op, tree, operand)
+    return tree
+
+
+@optional_macro("balance_strings", after=expand_array_literals)
+def balance_strings(ast: tuple) -> tuple:
+    """Expand the string literals into a balanced tree of short left-deep chains of characters, rather
+    than into a single left-deep chain with one level per character. String concatenation is
+    associative, so the string is the same. Fully balanced trees are no good, since the pyramids at
+    the top have to be as wide as the whole subtrees under them. The chains are of ``chain_size``, so
+    both the compiler and the interpreter recurse only as deep as one chain (plus the depth of the
+    balanced tree)."""
+
+    def expand(string: str) -> tuple | str:
+        if lexer.in_context(string, '""'):
+            characters = string_characters(string[1:-1])
+            if len(characters) < 3:
+                return string  # Nothing to balance. Leave it to expand_string_literals
+            size = chain_size(len(characters))
+            chains = [left_chain(characters[i : i + size], "+") for i in range(0, len(characters), size)]
+            return cast(tuple, balanced_chain(chains, "+"))
+        return string
+
+    return tree_traversal(ast, str_fun=expand)
+
+
 # ======================================================================================================================
 #
 #   #####   ##   ##  #####  #####  ##   ##  ##      ##             ####   #####   ###    ###  ###    ###
@@ -474,6 +618,52 @@ def expand_right_associative(ast: tuple) -> tuple:
     return tree_traversal(ast, pre_fun=expander)
 
 
+# ================================================================
+#
+#  #####   ####    ##      ####    ####  ##     ##   ####
+#  ##     ##  ##   ##      ##  ##   ##   ####   ##  ##
+#  #####  ##  ##   ##      ##  ##   ##   ##  ## ##  ##  ###
+#  ##     ##  ##   ##      ##  ##   ##   ##    ###  ##   ##
+#  ##      ####    ######  ####    ####  ##     ##   ####
+#
+# ================================================================
+
+_INTEGER = re.compile(r"-?(0|[1-9][0-9]*)")
+
+# Pyramid Scheme evaluates these on ruby integers. Division is missing on purpose: it always gives a
+# float, which has no integer literal. Negative powers give rationals, so they are not folded either.
+_FOLDABLE: dict[str, Callable[[int, int], int | None]] = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "^": lambda a, b: a**b if b >= 0 else None,
+    "=": lambda a, b: int(a == b),
+    "<=>": lambda a, b: (a > b) - (a < b),
+}
+
+
+@optional_macro("fold_constants", after=expand_right_associative)
+def fold_constants(ast: tuple) -> tuple:
+    """Evaluate the binary operations on integer literals at compile time, innermost first. The result
+    only replaces the operation if its literal is not longer than the operation written out."""
+
+    def folder(node: tuple) -> Node:
+        if len(node) != 3 or node[0] not in _FOLDABLE:
+            return node
+        op, a, b = node
+        if not (isinstance(a, str) and isinstance(b, str) and _INTEGER.fullmatch(a) and _INTEGER.fullmatch(b)):
+            return node
+        x, y = int(a), int(b)
+        if op == "^" and abs(x) > 1 and y > 0 and y * math.log10(abs(x)) >= len(op) + len(a) + len(b):
+            return node  # Has more digits than that, so don't even compute it
+        result = _FOLDABLE[op](x, y)
+        if result is None or len(str(result)) > len(op) + len(a) + len(b):
+            return node
+        return str(result)
+
+    return tree_traversal(ast, post_fun=folder)
+
+
 # =============================================================================================================
 #
 #  #####    #####    ####  ######            #####   #####     #####    ####
@@ -557,7 +747,217 @@ def underscore_keyword(ast: tuple) -> tuple:
     return tree_traversal(ast, str_fun=replacer)  # type: ignore
 
 
-def apply_processing_stack(ast: tuple, full_names: bool = False) -> tuple:
+# ========================================================================
+#
+#  ##   ##   ####    ####   ####   ######  ####  ##     ##   ####
+#  ##   ##  ##  ##    ##   ##        ##     ##   ####   ##  ##
+#  #######  ##  ##    ##    ###      ##     ##   ##  ## ##  ##  ###
+#  ##   ##  ##  ##    ##      ##     ##     ##   ##    ###  ##   ##
+#  ##   ##   ####    ####  ####      ##    ####  ##     ##   ####
+#
+# ========================================================================
+
+_NUMBER = re.compile(r"-?[0-9]+(\.[0-9]+)?")
+
+# Operations without side effects, which cannot fail either. A tree of them, on number literals only, is a
+# constant. A constant is hoisted out of branches and loops which might never run, so it must not be able to
+# raise an error. Hence a / only counts when it divides by a non-zero literal, a chr only on an in-range
+# character code, and a ^ never (0 to a negative power fails).
+_PURE_OPERATIONS = {"+", "-", "*", "=", "<=>"}
+
+
+def _cannot_fail(node: tuple) -> bool:
+    """Whether the operation of the node, on constant operands, never raises an error"""
+    text, left, right = node
+    operand = right[0] if isinstance(right, tuple) and right[1:] == (None, None) else None
+    if text in _PURE_OPERATIONS:
+        return left is not None and right is not None
+    if text == "/":
+        return left is not None and operand is not None and float(operand) != 0
+    if text == "chr":
+        return operand is not None and operand.isdigit() and int(operand) < 256
+    return False
+
+
+def constant_subtrees(ast: tuple) -> Counter[tuple]:
+    """Count the largest constant subtrees of the (fully processed) ast, which are not just literals"""
+    counts: Counter[tuple] = Counter()
+
+    def is_literal(node: Node) -> bool:
+        return node is None or node[1:] == (None, None)
+
+    def is_constant(node: Node) -> bool:
+        """Whether the node is constant. The largest constant subtrees under it are counted."""
+        if node is None:
+            return True
+        if isinstance(node, str):  # Empty tree
+            return False
+        text, left, right = node
+        if is_literal(node):
+            return isinstance(text, str) and bool(_NUMBER.fullmatch(text))
+        children = [(child, is_constant(child)) for child in (left, right)]
+        if all(constant for _, constant in children) and _cannot_fail(node):
+            return True
+        for child, constant in children:
+            if constant and isinstance(child, tuple) and not is_literal(child):
+                counts[child] += 1
+        return False
+
+    for node in ast:
+        if is_constant(node) and not is_literal(node):
+            counts[node] += 1
+    return counts
+
+
+def pyramids(node: Node) -> int:
+    """Number of the pyramids of the node"""
+    return 0 if node is None else 1 + pyramids(node[1]) + pyramids(node[2])
+
+
+@optional_macro("hoist_constants", after=underscore_keyword, whole_program=True)
+def hoist_constants(ast: tuple) -> tuple:
+    """Set each constant subtree which is repeated (such as a string, or a character) to a variable at
+    the start of the program, and use the variable instead. The constant is then built only once,
+    rather than every time it is evaluated (for example, in every iteration of a loop). Only the
+    subtrees which cannot fail count as constants, since the sets run even where their branch would not.
+    A subtree is only hoisted if the pyramids it saves well outnumber the ones of its set. The names of
+    the variables are the single letters which are not used in the program yet."""
+    taken: set[str] = set()
+
+    def name_finder(text: str) -> str:
+        taken.add(text)
+        return text
+
+    tree_traversal(ast, str_fun=name_finder)
+
+    hoisted: dict[tuple, tuple] = {}
+    sets = []
+    counts = constant_subtrees(ast)
+    for subtree, n in sorted(counts.items(), key=lambda item: -(item[1] - 1) * pyramids(item[0])):
+        size = pyramids(subtree)
+        if n * (size - 1) <= 2 * (size + 2):  # Each use is a pyramid, and the set two more. Twice, to be safe
+            continue
+        name = short_name(taken)
+        if name is None:
+            break  # No names left
+        taken.add(name)
+        hoisted[subtree] = (name, None, None)
+        sets.append(("set", (name, None, None), subtree))
+
+    if not hoisted:
+        return ast
+
+    def replacer(node: tuple) -> tuple:
+        return hoisted.get(node, node)
+
+    return tuple(sets) + cast(tuple, tree_traversal(ast, pre_fun=replacer))
+
+
+# ============================================================================================
+#
+#  ####    #####    ###    ####           ####   ######   ####    #####    #####   ####
+#  ##  ##  ##      ## ##   ##  ##        ##        ##    ##  ##   ##  ##   ##     ##
+#  ##  ##  #####  ##   ##  ##  ##         ###      ##    ##  ##   #####    #####   ###
+#  ##  ##  ##     #######  ##  ##           ##     ##    ##  ##   ##  ##   ##        ##
+#  ####    #####  ##   ##  ####          ####      ##     ####    ##   ##  #####  ####
+#
+# ============================================================================================
+
+# Anything under these can have an effect. (A loop or a do can also just never finish.) A # of line reads
+# a line of the input, and the argument of the # is only known at run time, so any # counts. An arg only
+# looks at the command-line arguments, which never change, so it does not.
+_SIDE_EFFECTS = {"out", "set", "loop", "do", "#"}
+
+
+def read_variables(ast: tuple) -> set[str]:
+    """Names of all the variables read in the (fully processed) ast"""
+    names: set[str] = set()
+
+    def reader(node: Node) -> None:
+        if node is None or isinstance(node, str):
+            return
+        text, left, right = cast(tuple[str, Node, Node], node)
+        if left is None and right is None:
+            names.add(text)
+        elif text != "set" or left[1:] != (None, None):  # type: ignore
+            reader(left)
+        reader(right)  # The target of the set is written, not read
+
+    for node in ast:
+        reader(node)
+    return names
+
+
+def has_side_effects(node: Node) -> bool:
+    """Whether evaluating the node can have any effect, besides its value"""
+    if node is None or isinstance(node, str):
+        return False
+    return node[0] in _SIDE_EFFECTS or has_side_effects(node[1]) or has_side_effects(node[2])
+
+
+def remove_dead_stores(ast: tuple) -> tuple[tuple, int]:
+    """Remove the statements which set a variable which is never read, to a value without side effects.
+    The statements are the top-level forms, the halves of the empty pyramids grouping statements, and
+    the bodies of the statement keywords (see ``optimisers.statements``). Anywhere else, an empty
+    pyramid is an array, and its values are used. Removing a store can make others dead too, so this
+    repeats until there are no dead stores left. Returns the new ast, and the number of the pyramids
+    removed."""
+    removed = 0
+
+    def is_dead(node: Node, read: set[str]) -> bool:
+        return (
+            isinstance(node, tuple)
+            and node[0] == "set"
+            and node[1] is not None
+            and node[1][1:] == (None, None)
+            and node[1][0] not in read
+            and not has_side_effects(node[2])
+        )
+
+    def statement(node: Node, read: set[str]) -> Node:
+        """The statement, without its dead stores, or None if it is one"""
+        nonlocal removed
+        if is_dead(node, read):
+            removed += pyramids(node)
+            return None
+        if not isinstance(node, tuple):
+            return node
+        text, left, right = node
+        if text == "":
+            return ("", statement(left, read), statement(right, read))
+        if text in STATEMENT_KEYWORDS:
+            return (text, left, statement(right, read))
+        return node
+
+    while True:
+        read = read_variables(ast)
+        count = removed
+        forms = (statement(node, read) for node in ast)
+        ast = tuple(node for node in forms if node is not None) or ("",)  # The program can't be empty
+        if removed == count:
+            return ast, removed
+
+
+@optional_macro("eliminate_dead_stores", after=underscore_keyword, whole_program=True)
+def eliminate_dead_stores(ast: tuple) -> tuple:
+    """Remove the sets of the variables which are never read (see ``remove_dead_stores``)"""
+    return remove_dead_stores(ast)[0]
+
+
+def processing_stack(full_names: bool = False, optional: Iterable[str] = ()) -> list[Macro]:
+    """The macros to apply, in order, including the selected ``optional`` ones"""
+    optional = set(optional)
+    unknown = optional - __optional_macros__.keys()
+    if unknown:
+        raise ValueError(f"Unknown optional macros: {', '.join(sorted(unknown))}")
+    stack = []
+    for macro in __processing_stack__[1:] if full_names else __processing_stack__:
+        stack.append(macro)
+        stack.extend(fun for name, (fun, after) in __optional_macros__.items() if name in optional and after is macro)
+    return stack
+
+
+def apply_processing_stack(ast: tuple, full_names: bool = False, optional: Iterable[str] = ()) -> tuple:
     """Apply the processing stack to the ast"""
-    stack = __processing_stack__[1:] if full_names else __processing_stack__
+    stack = processing_stack(full_names, optional)
     return reduce(lambda x, y: y(x), [ast] + list(stack))  # type: ignore
@@ -4,31 +4,181 @@ Optimisers work on the abstract syntax tree to improve byte count of the compile
 
 from __future__ import annotations
 
-from collections.abc import Generator
-from typing import TYPE_CHECKING, Callable
+from collections.abc import Generator, Iterator
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple
 
 if TYPE_CHECKING:
     from typing_extensions import _T
 
+import heapq
+import json
+import math
 import operator
+import os
+import random
+import time
 from itertools import chain
 
 from more_itertools import windowed_complete
 
 from . import build
 
+# Keywords whose right child is evaluated only for its side effects (when the keyword itself is a statement)
+STATEMENT_KEYWORDS = {"loop", "do", "?"}
 
-def greedy_optimisation(ast: tuple, verbose: bool = True, max_iter: int | None = None) -> tuple:
-    """Greedily insert empty trees into the abstract syntax tree"""
+# Cost of a program, from its metrics. Anything comparable will do. Ties are broken by the byte count.
+Cost = Callable[[build.program_metrics], Any]
 
-    def candidates(ast: tuple) -> Generator[tuple, None, None]:
-        for b, m, e in windowed_complete(ast, 2):  # Try all the pairs
-            yield (*b, ("", m[0], m[1]), *e)
-        for b, m, e in windowed_complete(ast, 1):  # Finally try all the single pyramids
-            yield (*b, ("", m[0], None), *e)
-            yield (*b, ("", None, m[0]), *e)
+COSTS: dict[str, Cost] = {
+    "bytes": lambda m: m.bytes,
+    "lines": lambda m: (m.lines, m.bytes),
+    "width": lambda m: (m.width, m.bytes),
+    "area": lambda m: (m.lines * m.width, m.bytes),
+}
 
-    iter_count = 0
+
+def weighted_cost(byte_weight: float = 1.0, line_weight: float = 0.0, width_weight: float = 0.0) -> Cost:
+    """Weighted sum of the metrics of the program"""
+    return lambda m: (byte_weight * m.bytes + line_weight * m.lines + width_weight * m.width, m.bytes)
+
+
+def program_cost(ast: tuple, cost: Cost | None = None) -> Any:
+    """Cost of the program built from the ast. Just its length, by default."""
+    if cost is None:
+        return len(build.build(ast))
+    return cost(build.metrics(build.build_program_tree(ast)))
+
+
+def statements(ast: tuple) -> tuple:
+    """Canonical form of the program, up to the placement of the empty pyramids.
+
+    The value of a top-level tree is never used, and neither is the value of an empty pyramid
+    grouping statements, so such groups (and lone empty pyramids) are flattened into a list of
+    statements. Same goes for the bodies of the statement keywords. Two programs with the same
+    canonical form do the same thing."""
+
+    def expression(node: tuple | str | None) -> tuple | None:
+        if node is None or isinstance(node, str):
+            return node if node is None else (node, None, None)
+        return (node[0], expression(node[1]), expression(node[2]))
+
+    def flatten(node: tuple | str | None) -> list:
+        if node is None:
+            return []
+        if isinstance(node, str):
+            node = (node, None, None)
+        if node[0] == "":
+            return flatten(node[1]) + flatten(node[2])
+        return [statement(node)]
+
+    def statement(node: tuple) -> tuple:
+        if node[0] in STATEMENT_KEYWORDS:
+            return (node[0], expression(node[1]), tuple(flatten(node[2])))
+        return (node[0], expression(node[1]), expression(node[2]))
+
+    return tuple(s for node in ast for s in flatten(node))
+
+
+class progress_event(NamedTuple):
+    optimiser: str
+    iteration: int
+    best_length: Any  # Or the best cost, if the optimiser was given a cost function
+    candidates: int  # Candidates evaluated in this iteration
+    candidates_per_second: float
+    cache_hit_rate: float | None  # Fraction of the trees built in this iteration which came from the cache
+    iteration_time: float  # Seconds
+
+
+class ProgressTimer:
+    """Times a single iteration of an optimiser, and makes the ``progress_event`` at its end"""
+
+    def __init__(self, optimiser: str):
+        self.optimiser = optimiser
+        self.start, self.cache_start = time.perf_counter(), build.cache_info()
+
+    def event(self, iteration: int, best_length: int, candidates: int) -> progress_event:
+        elapsed = time.perf_counter() - self.start
+        hit_rate, cache_end = None, build.cache_info()
+        if self.cache_start is not None and cache_end is not None:
+            hits, misses = (end - start for start, end in zip(self.cache_start, cache_end))
+            hit_rate = hits / (hits + misses) if hits + misses else None
+        per_second = candidates / elapsed if elapsed > 0 else 0.0
+        return progress_event(self.optimiser, iteration, best_length, candidates, per_second, hit_rate, elapsed)
+
+
+class checkpoint(NamedTuple):
+    ast: tuple
+    iteration: int
+    optimiser: str
+
+
+class Checkpointer:
+    """Saves the state of an optimiser to ``filename`` every ``every`` iterations and/or every
+    ``seconds`` seconds (whichever comes first), such that a long optimisation can be resumed."""
+
+    def __init__(self, filename: str, every: int | None = 1, seconds: float | None = None):
+        self.filename = filename
+        self.every = every
+        self.seconds = seconds
+        self.last_save = time.perf_counter()
+
+    def __call__(self, ast: tuple, iteration: int, optimiser: str, force: bool = False) -> None:
+        due = force or (self.every is not None and iteration % self.every == 0)
+        due = due or (self.seconds is not None and time.perf_counter() - self.last_save >= self.seconds)
+        if due:
+            save_checkpoint(self.filename, checkpoint(ast, iteration, optimiser))
+            self.last_save = time.perf_counter()
+
+
+def save_checkpoint(filename: str, state: checkpoint) -> None:
+    """Save the checkpoint as json. Write to a temporary file first, so that a crash while saving
+    does not destroy the previous checkpoint."""
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        json.dump(state._asdict(), f)
+    os.replace(temp_filename, filename)
+
+
+def load_checkpoint(filename: str) -> checkpoint:
+    """Load a checkpoint saved by ``save_checkpoint``"""
+
+    def to_tuples(node: Any) -> Any:
+        return tuple(to_tuples(n) for n in node) if isinstance(node, list) else node
+
+    with open(filename) as f:
+        state = json.load(f)
+    return checkpoint(to_tuples(state["ast"]), state["iteration"], state["optimiser"])
+
+
+def windows(ast: tuple, n: int) -> Iterator[tuple]:
+    """All the windows of ``n`` adjacent top-level trees, with what comes before and after them. None if the
+    abstract syntax tree is shorter than ``n`` (rather than the error from ``windowed_complete``)"""
+    return windowed_complete(ast, n) if len(ast) >= n else iter(())
+
+
+def greedy_candidates(ast: tuple) -> Generator[tuple, None, None]:
+    """All the ways to insert a single empty tree into the top level of the abstract syntax tree"""
+    for b, m, e in windows(ast, 2):  # Try all the pairs
+        yield (*b, ("", m[0], m[1]), *e)
+    for b, m, e in windows(ast, 1):  # Finally try all the single pyramids
+        yield (*b, ("", m[0], None), *e)
+        yield (*b, ("", None, m[0]), *e)
+
+
+def greedy_optimisation(
+    ast: tuple,
+    verbose: bool = True,
+    max_iter: int | None = None,
+    checkpointer: Checkpointer | None = None,
+    start_iter: int = 0,
+    progress: Callable[[progress_event], None] | None = None,
+    cost: Cost | None = None,
+) -> tuple:
+    """Greedily insert empty trees into the abstract syntax tree. Resume from a checkpoint by
+    passing its ast and ``start_iter``. ``progress`` is called at the end of each iteration.
+    Minimises the ``cost`` of the program, or its length by default."""
+
+    iter_count = start_iter
     if verbose:
         print("Greedy tree optimisation")
     while True:
@@ -36,16 +186,26 @@ def greedy_optimisation(ast: tuple, verbose: bool = True, max_iter: int | None =
         if max_iter and iter_count > max_iter:
             break
 
-        N = len(build.build(ast))
-        for candidate in candidates(ast):
-            M = len(build.build(candidate))
+        timer = ProgressTimer("greedy")
+        N, candidates = program_cost(ast, cost), 0
+        for candidate in greedy_candidates(ast):
+            candidates += 1
+            M = program_cost(candidate, cost)
             if M < N:
                 if verbose:
                     print(f"{iter_count} | Old len: {N} | New len: {M}")
                 ast = candidate
                 break  # Greedily accept the new ast
         else:
+            if progress:
+                progress(timer.event(iter_count, N, candidates))
             break  # Break from the while loop
+        if progress:
+            progress(timer.event(iter_count, M, candidates))
+        if checkpointer:
+            checkpointer(ast, iter_count, "greedy")
+    if checkpointer:
+        checkpointer(ast, iter_count, "greedy", force=True)
     return ast
 
 
@@ -61,26 +221,39 @@ def repeat(func: Callable[[_T], _T], n: int, arg: _T) -> _T:
     return out
 
 
+wrap_left = lambda node: ("", node, None)  # Wrap a node
+wrap_right = lambda node: ("", None, node)  # Wrap a node
+
+
+def considerate_candidates(ast: tuple, max_depth: int = 10) -> Generator[tuple, None, None]:
+    """All the ways to wrap a single top-level tree, or a pair of adjacent ones, in up to ``max_depth`` trees"""
+    for b, m, e in chain(windows(ast, 1), windows(ast, 2)):
+        m = ("", m[0], m[1]) if len(m) == 2 else m[0]
+        for d in range(1, max_depth):
+            yield (*b, repeat(wrap_left, d, m), *e)
+        for d in range(1, max_depth):
+            yield (*b, repeat(wrap_right, d, m), *e)
+
+
 def considerate_optimisation(
     ast: tuple,
     verbose: bool = True,
     max_iter: int | None = None,
     max_depth: int = 10,
+    checkpointer: Checkpointer | None = None,
+    start_iter: int = 0,
+    progress: Callable[[progress_event], None] | None = None,
+    cost: Cost | None = None,
 ) -> tuple:
-    """Consider all the possible places to insert a tree up to ``max_depth``"""
-
-    wrap_left = lambda node: ("", node, None)  # Wrap a node
-    wrap_right = lambda node: ("", None, node)  # Wrap a node
+    """Consider all the possible places to insert a tree up to ``max_depth``. Resume from a
+    checkpoint by passing its ast and ``start_iter``. ``progress`` is called at the end of each
+    iteration. Minimises the ``cost`` of the program, or its length by default.
 
-    def candidates(ast: tuple) -> Generator[tuple, None, None]:
-        for b, m, e in chain(windowed_complete(ast, 1), windowed_complete(ast, 2)):
-            m = ("", m[0], m[1]) if len(m) == 2 else m[0]
-            for d in range(1, max_depth):
-                yield (*b, repeat(wrap_left, d, m), *e)
-            for d in range(1, max_depth):
-                yield (*b, repeat(wrap_right, d, m), *e)
+    The length of each candidate is worked out from the extents of the rows of its trees alone (see
+    ``build.program_length_of_trees``), without putting the trees together. With any other ``cost``
+    all the candidates get built."""
 
-    iter_count = 0
+    iter_count = start_iter
     if verbose:
         print("Considerate optimisation")
     while True:
@@ -88,13 +261,369 @@ def considerate_optimisation(
         if max_iter and iter_count > max_iter:
             break
 
-        N = len(build.build(ast))
-        lengths = ((len(build.build(c)), c) for c in candidates(ast))
-        M, candidate = min(lengths, key=operator.itemgetter(0))
+        timer = ProgressTimer("considerate")
+        N = program_cost(ast, cost)
+        (M, candidate), total = (N, ast), 0
+        for c in considerate_candidates(ast, max_depth):
+            total += 1
+            length = build.program_length_of_trees(build.build_trees(c)) if cost is None else program_cost(c, cost)
+            if length < M:
+                M, candidate = length, c
+        if verbose:
+            result = f"New len: {M}" if M < N else "No improvement"
+            print(f"{iter_count} | Old len: {N} | {result} | Candidates: {total}")
+        if progress:
+            progress(timer.event(iter_count, M, total))
         if M < N:
-            if verbose:
-                print(f"{iter_count} | Old len: {N} | New len: {M}")
             ast = candidate
         else:
             break  # Break from the while loop
+        if checkpointer:
+            checkpointer(ast, iter_count, "considerate")
+    if checkpointer:
+        checkpointer(ast, iter_count, "considerate", force=True)
     return ast
+
+
+def optimal_optimisation(
+    ast: tuple,
+    verbose: bool = True,
+    max_depth: int = 10,
+    max_span: int | None = 8,
+) -> tuple:
+    """Find the best grouping and wrapping of the top-level trees with dynamic programming over the
+    contiguous ranges of the top-level trees.
+
+    ``best[i, j]`` is the best single tree made out of ``ast[i:j]``: either one of the ways to split
+    the range in two and put the halves under an empty pyramid, or a top-level tree on its own,
+    optionally wrapped up to ``max_depth``. It is scored in the context of ``prefix[i]``, the best
+    arrangement of ``ast[:i]``, and hence ``prefix[j]`` is just the best ``prefix[i]`` + ``best[i, j]``.
+    All the subproblems are memoised, so there are O(n * max_span * (max_span + max_depth)) candidates
+    for n top-level trees. Each one is scored together with all the trees after it, from the extents of
+    their rows alone (see ``build.Contour``), so this takes O(n^2 * max_span * (max_span + max_depth))
+    steps of the contour (or O(n^4) if the ranges are not limited by ``max_span``)."""
+
+    n = len(ast)
+    max_span = max_span or n
+    best: dict[tuple[int, int], tuple[int, tuple]] = {}
+    prefix: dict[int, tuple[int, tuple]] = {0: (0, ())}
+    contours = {0: build.Contour()}  # Contour of each prefix
+
+    def score(node: tuple, before: build.Contour, after: tuple) -> tuple[int, tuple]:
+        """Length of the whole program with the node between the contour before it and the trees after it"""
+        return build.program_length_of_trees(build.build_trees((node, *after)), before), node
+
+    if verbose:
+        print("Optimal optimisation")
+
+    for j in range(1, n + 1):
+        after = ast[j:]
+        for i in reversed(range(max(j - max_span, 0), j)):
+            before = contours[i]
+            if j - i == 1:
+                base = score(ast[i], before, after)
+            else:
+                splits = (score(("", best[i, k][1], best[k, j][1]), before, after) for k in range(i + 1, j))
+                base = min(splits, key=operator.itemgetter(0))
+            wraps = (
+                score(repeat(wrap, d, base[1]), before, after)
+                for wrap in (wrap_left, wrap_right)
+                for d in range(1, max_depth)
+            )
+            best[i, j] = min(chain((base,), wraps), key=operator.itemgetter(0))
+        M, i = min((best[i, j][0], i) for i in range(max(j - max_span, 0), j))
+        prefix[j] = (M, (*prefix[i][1], best[i, j][1]))
+        tree = build.build_tree(best[i, j][1])
+        assert tree is not None
+        contours[j] = contours[i].copy()
+        contours[j].add(tree)
+        if verbose:
+            print(f"{j}/{n} | Best len: {M}")
+
+    N, (M, candidate) = len(build.build(ast)), prefix[n]
+    if verbose:
+        print(f"Old len: {N} | New len: {M}")
+    return candidate if M < N else ast
+
+
+def beam_search_optimisation(
+    ast: tuple,
+    beam_width: int = 8,
+    time_budget: float | None = None,
+    verbose: bool = True,
+    max_iter: int | None = None,
+    max_depth: int = 10,
+    cost: Cost | None = None,
+) -> tuple:
+    """Keep the ``beam_width`` best candidates of each round, rather than just the best one, so that the
+    search can climb out of the local minima of the greedy and considerate optimisations. Candidates
+    are generated by both of them and deduplicated, so each distinct ast is only scored once. Stops
+    when a round does not improve on the best ast so far, or when ``time_budget`` seconds run out.
+    Minimises the ``cost`` of the program, or its length by default."""
+
+    start = time.perf_counter()
+    out_of_time = lambda: time_budget is not None and time.perf_counter() - start > time_budget
+
+    N = program_cost(ast, cost)
+    best, beam, seen = (N, ast), [(N, ast)], {ast}
+    iter_count = 0
+    if verbose:
+        print(f"Beam search optimisation (width {beam_width})")
+    while beam and not out_of_time():
+        iter_count += 1
+        if max_iter and iter_count > max_iter:
+            break
+
+        scored = []
+        for _, parent in beam:
+            for candidate in chain(greedy_candidates(parent), considerate_candidates(parent, max_depth)):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                # Like the considerate optimisation, the length comes from the extents of the rows alone
+                if cost is None:
+                    score = build.program_length_of_trees(build.build_trees(candidate))
+                else:
+                    score = program_cost(candidate, cost)
+                scored.append((score, candidate))
+                if out_of_time():
+                    break
+            else:
+                continue
+            break  # Out of time. Still take the best of what we have got
+        if not scored:
+            break
+
+        beam = heapq.nsmallest(beam_width, scored, key=operator.itemgetter(0))
+        if beam[0][0] >= best[0]:
+            break  # No candidate in this round beats the best one so far
+        best = beam[0]
+        if verbose:
+            print(f"{iter_count} | Old len: {N} | New len: {best[0]} | Candidates: {len(scored)}")
+    return best[1]
+
+
+def annealing_move(ast: tuple, i: int, move: int) -> tuple | None:
+    """One of the small changes to the top level of the abstract syntax tree which the annealing can make,
+    to the ``i``-th tree: wrap it in one more empty pyramid on the left (``move`` 0) or on the right (1),
+    group it with the next tree (2), or undo any of these (3). None if the move does not apply to the tree."""
+    b, node, e = ast[:i], ast[i], ast[i + 1 :]
+    if move == 0:
+        return (*b, wrap_left(node), *e)
+    if move == 1:
+        return (*b, wrap_right(node), *e)
+    if move == 2:
+        return (*b, ("", node, e[0]), *e[1:]) if e else None
+    if isinstance(node, tuple) and node[0] == "":
+        # Empty pyramids at the top level are just statement groups
+        return (*b, *(n for n in node[1:] if n is not None), *e)
+    return None
+
+
+def annealing_optimisation(
+    ast: tuple,
+    iterations: int | None = 10_000,
+    time_budget: float | None = None,
+    seed: int | None = None,
+    temperature: float = 10.0,
+    verbose: bool = True,
+) -> tuple:
+    """Make random insertions, wrappings and regroupings of the top-level trees, and accept them
+    according to a simulated annealing schedule. The temperature starts at ``temperature`` (in
+    characters of the program) and cools down exponentially over the ``iterations`` (or over the
+    ``time_budget``, if there is no iteration limit). The same ``seed`` gives the same
+    result, as long as the search is bounded by the iterations and not by the time."""
+
+    if iterations is None and time_budget is None:
+        raise ValueError("Annealing needs either the number of iterations or a time budget")
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+
+    # A move only changes the trees from the index of the move on, so a candidate is scored from the
+    # contour of the trees before that index in the current ast (kept until a move changes them), and
+    # the (lru cached) trees after it. The annealing often goes back and forth, so remember the lengths.
+    lengths: dict[tuple, int] = {}
+    prefixes = [build.Contour()]  # Contours of the first 0, 1, 2, ... trees of the current ast
+
+    def prefix(i: int) -> build.Contour:
+        for tree in build.build_trees(ast[len(prefixes) - 1 : i]):
+            contour = prefixes[-1].copy()
+            contour.add(tree)
+            prefixes.append(contour)
+        return prefixes[i]
+
+    def length(candidate: tuple, i: int = 0) -> int:
+        if candidate not in lengths:
+            lengths[candidate] = build.program_length_of_trees(build.build_trees(candidate[i:]), prefix(i))
+        return lengths[candidate]
+
+    def random_move(ast: tuple) -> tuple[tuple, int]:
+        # Every move is equally likely: draw any tree and any move until the move applies to the tree
+        while True:
+            i = rng.randrange(len(ast))
+            candidate = annealing_move(ast, i, rng.randrange(4))
+            if candidate is not None:
+                return candidate, i
+
+    def progress(iter_count: int) -> float:
+        if iterations is not None:
+            return iter_count / iterations
+        return (time.perf_counter() - start) / time_budget  # type: ignore
+
+    N = current = length(ast)
+    best = (N, ast)
+    T0, T_end = temperature, 0.1
+    if verbose:
+        print(f"Annealing optimisation (seed {seed})")
+
+    iter_count = 0
+    while progress(iter_count) < 1:
+        if time_budget is not None and time.perf_counter() - start > time_budget:
+            break
+        iter_count += 1
+
+        T = T0 * (T_end / T0) ** progress(iter_count)
+        candidate, i = random_move(ast)
+        new = length(candidate, i)
+        if new <= current or rng.random() < math.exp((current - new) / T):
+            ast, current = candidate, new
+            del prefixes[i + 1 :]  # The trees before the move are the same
+            if new < best[0]:
+                best = (new, ast)
+                if verbose:
+                    print(f"{iter_count} | Old len: {N} | New len: {new} | T: {T:.2f}")
+
+    return best[1]
+
+
+def statement_list(node: tuple | str | None) -> list:
+    """Statements grouped under the empty pyramids of a statement position, in order. Unlike
+    ``statements``, the statements themselves are left as they are."""
+    if node is None or node == "":
+        return []
+    if isinstance(node, tuple) and node[0] == "":
+        return statement_list(node[1]) + statement_list(node[2])
+    return [node]
+
+
+def group_statements(stmts: tuple, max_depth: int = 10) -> tuple | str:
+    """Put the statements under empty pyramids, into a single tree which is as small as possible on
+    its own. Same as ``optimal_optimisation``, but each range of statements becomes a single tree."""
+    length = lambda node: build.program_length(build.build_tree(node))
+    score = lambda node: (length(node), node)
+
+    n = len(stmts)
+    best: dict[tuple[int, int], tuple[int, tuple | str]] = {}
+    for span in range(1, n + 1):
+        for i in range(n - span + 1):
+            j = i + span
+            if span == 1:
+                base = score(stmts[i])
+            else:
+                splits = (score(("", best[i, k][1], best[k, j][1])) for k in range(i + 1, j))
+                base = min(splits, key=operator.itemgetter(0))
+            wraps = (score(repeat(wrap, d, base[1])) for wrap in (wrap_left, wrap_right) for d in range(1, max_depth))
+            best[i, j] = min(chain((base,), wraps), key=operator.itemgetter(0))
+    return best[0, n][1]
+
+
+def subtree_optimisation(ast: tuple, verbose: bool = True, max_depth: int = 10) -> tuple:
+    """Optimise the bodies of the statement keywords (``loop``, ``do`` and ``?``), at any depth.
+
+    The body of a keyword is usually a long list of statements which ``expand_overfull_brackets``
+    packed into the empty pyramids two by two. Here, the statements are regrouped (and wrapped) to
+    make the whole keyword tree as small as possible, innermost bodies first. The top-level
+    optimisations never look inside the top-level trees, so this is best followed by one of them.
+    Each distinct subtree is optimised only once, and reused wherever else it appears."""
+
+    memo: dict[tuple, tuple] = {}
+    length = lambda node: build.program_length(build.build_tree(node))
+
+    def optimise(node: tuple | str | None) -> tuple | str | None:
+        """Optimise a node in a statement position"""
+        if not isinstance(node, tuple):
+            return node
+        if node[0] == "":
+            return ("", optimise(node[1]), optimise(node[2]))
+        if node[0] not in STATEMENT_KEYWORDS or node[2] is None:
+            return node
+        if node not in memo:
+            # Either keep the grouping of the body as it was, or regroup its statements from scratch
+            keyword, condition, body = node
+            candidates = [(keyword, condition, optimise(body))]
+            stmts = tuple(optimise(s) for s in statement_list(body))
+            if stmts:
+                candidates.append((keyword, condition, group_statements(stmts, max_depth)))
+            memo[node] = min(candidates, key=length)
+        return memo[node]
+
+    if verbose:
+        print("Subtree optimisation")
+    N = len(build.build(ast))
+    candidate = tuple(optimise(node) for node in ast)
+    M = len(build.build(candidate))
+    if verbose:
+        print(f"Old len: {N} | New len: {M} | Subtrees: {len(memo)}")
+    return candidate if M < N else ast
+
+
+def dominates(a: tuple, b: tuple) -> bool:
+    """Is ``a`` at least as good as ``b`` in all the objectives, and better in at least one?"""
+    return all(x <= y for x, y in zip(a, b)) and a != b
+
+
+def pareto_optimisation(
+    ast: tuple,
+    objectives: tuple[str, ...] = ("bytes", "lines", "width"),
+    verbose: bool = True,
+    max_iter: int | None = None,
+    max_depth: int = 10,
+    max_front: int = 16,
+) -> list[tuple[build.program_metrics, tuple]]:
+    """Find the variants of the program which are not dominated by each other in the ``objectives``
+    (the fields of ``build.program_metrics``), rather than just a single best one. Each round, the
+    greedy and considerate candidates of all the variants in the front are added to it, and the
+    dominated ones are dropped. If the front gets bigger than ``max_front``, it is thinned out evenly.
+
+    Returns the metrics and the ast of each variant, sorted by the objectives."""
+
+    def vector(m: build.program_metrics) -> tuple:
+        return tuple(getattr(m, o) for o in objectives)
+
+    def thin(front: dict[tuple, build.program_metrics]) -> dict[tuple, build.program_metrics]:
+        if len(front) <= max_front:
+            return front
+        ordered = sorted(front, key=lambda a: vector(front[a]))
+        picks = {round(i * (len(ordered) - 1) / (max_front - 1)) for i in range(max_front)}
+        return {ordered[i]: front[ordered[i]] for i in sorted(picks)}
+
+    metrics = lambda ast: build.metrics(build.build_program_tree(ast))
+    front, seen, expanded = {ast: metrics(ast)}, {ast}, set()
+    iter_count = 0
+    if verbose:
+        print(f"Pareto optimisation ({', '.join(objectives)})")
+    while True:
+        iter_count += 1
+        if max_iter and iter_count > max_iter:
+            break
+
+        candidates = dict(front)
+        for parent in [a for a in front if a not in expanded]:
+            expanded.add(parent)
+            for candidate in chain(greedy_candidates(parent), considerate_candidates(parent, max_depth)):
+                if candidate not in seen:
+                    seen.add(candidate)
+                    candidates[candidate] = metrics(candidate)
+
+        # Only keep one variant for each value of the objectives
+        unique = {vector(m): (a, m) for a, m in reversed(candidates.items())}
+        new_front = {a: m for v, (a, m) in unique.items() if not any(dominates(u, v) for u in unique)}
+        new_front = thin(new_front)
+        if verbose:
+            print(f"{iter_count} | Front: {len(new_front)} | Candidates: {len(candidates)}")
+        if new_front.keys() == front.keys():
+            break
+        front = new_front
+
+    return sorted(((m, a) for a, m in front.items()), key=lambda ma: vector(ma[0]))
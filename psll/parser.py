@@ -0,0 +1,89 @@
+"""
+Parser of (ASCII) Pyramid Scheme source back into the abstract syntax tree.
+"""
+
+from __future__ import annotations
+
+from typing import NamedTuple
+
+from . import PsllSyntaxError
+from .ascii_trees import BOTTOM, L_SIDE, R_SIDE, SPACE, TOP
+
+
+class pyramid(NamedTuple):
+    row: int  # Row of the tip
+    col: int  # Column of the tip
+    height: int  # Number of rows, from the tip to the base (inclusive)
+    content: str
+    left: int | None  # Index of the left child in the list of pyramids
+    right: int | None  # Index of the right child in the list of pyramids
+
+
+def _find_all(line: str, char: str) -> list[int]:
+    """Find all the positions of ``char`` in ``line``"""
+    positions, i = [], line.find(char)
+    while i != -1:
+        positions.append(i)
+        i = line.find(char, i + 1)
+    return positions
+
+
+def _char(lines: list[str], row: int, col: int) -> str:
+    """Character at ``row``, ``col``, padding the ragged lines with spaces"""
+    if 0 <= row < len(lines) and 0 <= col < len(lines[row]):
+        return lines[row][col]
+    return SPACE
+
+
+def parse_pyramids(text: str) -> tuple[list[pyramid], list[int]]:
+    """Find all the pyramids in the source and how they connect. Returns the list of pyramids
+    and the indices of the root pyramids, in the order of evaluation."""
+    lines = text.split("\n")
+
+    # Tips of pyramids, in reading order. Each pyramid is traced down from its tip one row at a time.
+    # '^' can also be the content of a pyramid, so mask those out as we go.
+    tips: dict[tuple[int, int], int] = {}
+    traced: list[tuple[int, int, int, str]] = []
+    masked: set[tuple[int, int]] = set()
+    for r, line in enumerate(lines):
+        for c in _find_all(line, TOP):
+            if (r, c) in masked:
+                continue
+            k, rows = 1, []
+            while _char(lines, r + k, c - k) == L_SIDE and _char(lines, r + k, c + k) == R_SIDE:
+                front = lines[r + k][c - k + 1 : c + k]
+                masked.update((r + k, c - k + 1 + i) for i in _find_all(front, TOP))
+                rows.append(front)
+                k += 1
+            base = lines[r + k][c - k + 1 : c + k] if r + k < len(lines) else ""
+            if base != BOTTOM * (2 * k - 1):
+                raise PsllSyntaxError(f"Malformed pyramid with the tip at line {r + 1}, column {c + 1}")
+            tips[(r, c)] = len(traced)
+            traced.append((r, c, k + 1, "".join(rows).replace(SPACE, "")))
+
+    pyramids: list[pyramid] = []
+    children: set[int] = set()
+    for r, c, height, content in traced:
+        bottom = r + height - 1
+        left, right = tips.get((bottom, c - height + 1)), tips.get((bottom, c + height - 1))
+        children.update(i for i in (left, right) if i is not None)
+        pyramids.append(pyramid(r, c, height, content, left, right))
+
+    roots = [i for i in range(len(pyramids)) if i not in children]
+    return pyramids, roots
+
+
+def parse(text: str) -> tuple:
+    """Parse Pyramid Scheme source into the abstract syntax tree"""
+    pyramids, roots = parse_pyramids(text)
+
+    # Children always have their tips below the tips of their parents, so going bottom-up means
+    # all the children are already parsed by the time we get to the parent (and no recursion).
+    nodes: list[tuple | None] = [None] * len(pyramids)
+    for i in sorted(range(len(pyramids)), key=lambda i: pyramids[i].row, reverse=True):
+        p = pyramids[i]
+        left = nodes[p.left] if p.left is not None else None
+        right = nodes[p.right] if p.right is not None else None
+        nodes[i] = (p.content, left, right)
+
+    return tuple(nodes[i] for i in roots)
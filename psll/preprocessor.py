@@ -1,4 +1,8 @@
+import codecs
+import io
 import re
+from collections.abc import Iterator
+from typing import TextIO
 
 
 def read_file(filename: str) -> str:
@@ -8,6 +12,36 @@ def read_file(filename: str) -> str:
     return text
 
 
+def read_chunks(stream: TextIO, size: int = 1 << 16) -> Iterator[str]:
+    """Read the stream in chunks of whatever is available, without waiting for the end of a line (or for a
+    whole chunk). Pipes are read through their binary buffer, since the text layer waits for all ``size``"""
+    buffer = getattr(stream, "buffer", None)
+    if buffer is None or not hasattr(buffer, "read1"):
+        while chunk := stream.read(size):
+            yield chunk
+        return
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(stream.encoding)(), translate=True)
+    while chunk := buffer.read1(size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def read_programs(stream: TextIO) -> Iterator[str]:
+    """Read NUL-separated programs from the stream, yielding each one as soon as its separator arrives.
+    Whitespace after the last separator is not a program."""
+    pending: list[str] = []
+    for chunk in read_chunks(stream):
+        *complete, rest = chunk.split("\0")
+        for part in complete:
+            pending.append(part)
+            yield "".join(pending)
+            pending = []
+        pending.append(rest)
+    rest = "".join(pending)
+    if rest.strip():
+        yield rest
+
+
 _SUBS = (
     (r"//.*", ""),  # Remove comments
     (r"\n+", ""),  # Remove newlines
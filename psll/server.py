@@ -0,0 +1,182 @@
+"""
+Compile server, which keeps all the caches warm between compilations. Requests and responses are
+JSON objects, one per line, sent over a Unix socket.
+
+A request is ``{"source": "...", "options": {...}}`` and the response is either
+``{"program": "...", "metrics": {"bytes": ..., "lines": ..., "width": ...}, "time": ..., "cached": ...}``
+or ``{"error": "..."}``.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import Any, Callable
+
+from . import macros
+from .compiler import CompileSession
+
+Optimise = Callable[[tuple, dict[str, Any]], tuple]
+
+
+class ResultCache:
+    """Least recently used cache of the responses, with at most ``size`` entries"""
+
+    def __init__(self, size: int = 128):
+        self.size = size
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def program_metrics(program: str) -> dict[str, int]:
+    """Bytes, lines and width of the built program"""
+    lines = program.split("\n")
+    return {"bytes": len(program), "lines": len(lines), "width": max(map(len, lines))}
+
+
+class CompileServer:
+    """Serves compile requests on a Unix socket with a pool of ``workers`` threads. Each worker keeps
+    its own compile sessions, and all of them share the cache of the last ``cache_size`` responses.
+    ``optimise`` is called with the processed ast and the options of the request."""
+
+    def __init__(
+        self,
+        path: str,
+        optimise: Optimise | None = None,
+        workers: int = 4,
+        cache_size: int = 128,
+    ):
+        self.path = path
+        self.optimise = optimise
+        self.workers = workers
+        self.cache = ResultCache(cache_size)
+        self._local = threading.local()
+        self._socket: socket.socket | None = None
+        self._stopped = threading.Event()
+        self._shutdown_lock = threading.Lock()  # Both the caller and serve_forever itself shut down
+
+    def session(self, full_names: bool, optional: tuple[str, ...]) -> CompileSession:
+        """Compile session of the current worker"""
+        sessions: dict[tuple[bool, tuple[str, ...]], CompileSession] = self._local.__dict__.setdefault("sessions", {})
+        key = (full_names, optional)
+        if key not in sessions:
+            sessions[key] = CompileSession(full_names, optional=optional)
+        return sessions[key]
+
+    def handle_request(self, request: dict) -> dict:
+        """Compile the source of the request, or return the cached response of the same request"""
+        try:
+            source, options = request["source"], request.get("options", {})
+            key = json.dumps([source, options], sort_keys=True)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return {**cached, "cached": True}
+
+            start = time.perf_counter()
+            optional = tuple(name for name in macros.__optional_macros__ if options.get(name))
+            session = self.session(bool(options.get("full_names")), optional)
+            ast = session.process(source)
+            if self.optimise is not None:
+                ast = self.optimise(ast, options)
+            program = session.build(ast)
+            response = {"program": program, "metrics": program_metrics(program), "time": time.perf_counter() - start}
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+        self.cache.put(key, response)
+        return {**response, "cached": False}
+
+    def handle_connection(self, connection: socket.socket) -> None:
+        """Answer the requests of one client, until it closes the connection"""
+        with connection, connection.makefile("rw", encoding="utf-8") as stream:
+            for line in stream:
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    response = {"error": f"Invalid request: {e}"}
+                else:
+                    response = self.handle_request(request)
+                stream.write(json.dumps(response) + "\n")
+                stream.flush()
+
+    def serve_forever(self) -> None:
+        """Accept connections until shut down, and hand them to the pool of workers"""
+        remove_stale_socket(self.path)
+        listener = self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while not self._stopped.is_set():
+                    try:
+                        connection, _ = listener.accept()
+                    except OSError:
+                        break  # Socket closed by shutdown
+                    pool.submit(self.handle_connection, connection)
+        finally:
+            self.shutdown()
+
+    def shutdown(self) -> None:
+        """Stop accepting connections and remove the socket"""
+        self._stopped.set()
+        with self._shutdown_lock:
+            listener, self._socket = self._socket, None
+        if listener is not None:
+            with suppress(OSError):
+                listener.shutdown(socket.SHUT_RDWR)  # Wakes up the accept
+            listener.close()
+            with suppress(FileNotFoundError):
+                os.unlink(self.path)
+
+
+def remove_stale_socket(path: str) -> None:
+    """Remove the socket at ``path`` if it was left over by a server which did not shut down cleanly.
+    Anything else there, be it a file or the socket of a server which is still running, is an error."""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)  # Nobody is listening on it
+            return
+    raise FileExistsError(f"A server is already listening on {path}")
+
+
+def request(path: str, source: str, options: dict[str, Any] | None = None) -> dict:
+    """Send a compile request to the server listening on ``path`` and wait for the response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        with client.makefile("rw", encoding="utf-8") as stream:
+            stream.write(json.dumps({"source": source, "options": options or {}}) + "\n")
+            stream.flush()
+            response: dict = json.loads(stream.readline())
+            return response
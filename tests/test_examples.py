@@ -2,12 +2,16 @@ import glob
 import hashlib
 import os
 import subprocess
+import tempfile
 from functools import partial
 from typing import Callable, Optional
 
 import pytest
 from conftest import Subtests
 
+import psll
+from psll.__main__ import check_pyra, check_ruby
+
 # Get all the example outputs from the examples_outputs directory
 
 __this_file_dir__ = os.path.dirname(os.path.abspath(__file__))
@@ -112,18 +116,17 @@ def compile_and_run(
     ruby: Optional[str] = None,
     pyra: Optional[str] = None,
 ) -> str:
-    """Compile and run the given file, returning the output"""
-    args = ["psll", "compile-and-run"]
-    if ruby:
-        args += ["--ruby", ruby]
-    if pyra:
-        args += ["--pyra", pyra]
-    args += [filename]
-    return subprocess.check_output(
-        args,
-        stderr=subprocess.STDOUT,
-        text=True,
-    )
+    """Compile the given file in-process and run it with the pyramid scheme interpreter, returning the output"""
+    result = psll.compile_source(psll.preprocessor.read_file(filename))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_filename = os.path.join(tmpdir, "out.pyra")
+        with open(output_filename, "w") as f:
+            f.write(result.program)
+        return subprocess.check_output(
+            [check_ruby(ruby or ""), check_pyra(pyra or ""), output_filename],
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
 
 
 def compile(input_filename: str, output_filename: str, args: Optional[list[str]] = None) -> None:
@@ -1,11 +1,17 @@
 import os
 import random
+import socket
+import subprocess
 import sys
+import threading
+import time
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 # from itertools import product, permutations
 from contextlib import contextmanager
 from functools import partial
+from io import StringIO
 from string import ascii_letters
 from typing import Any, Callable, Optional, TypeVar
 
@@ -17,7 +23,11 @@ sys.path.append(os.path.realpath("."))
 from conftest import Subtests
 
 import psll
+import psll.compiler
 import psll.macros
+import psll.optimisers
+import psll.parser
+import psll.server
 
 Leaf = psll.macros.Leaf
 Node = psll.macros.Node
@@ -526,6 +536,37 @@ def test_array_expansion_strings(subtests: Subtests) -> None:
     paired_test(subtests, strings, targets, psll.macros.expand_array_literals)
 
 
+def test_range_keyword(subtests: Subtests) -> None:
+    """> Ranges are the same as the array literals of their elements"""
+    ranges = ["(range 1 5)", "(range 0 10 3)", "(range 3 3)", "(range 5 1)"]
+    arrays = ["[1 2 3 4 5]", "[0 3 6 9]", "[3]", "[]"]
+    for text, array in zip(ranges, arrays):
+        with subtests.test(text=text):
+            (ast,) = psll.macros.range_keyword(psll.lexer.lex(text))
+            assert ast == (psll.macros.expand_array_literals((array,))[0],)
+
+
+def test_array_expansion_long(subtests: Subtests) -> None:
+    """> Long arrays are balanced trees of chains, with all the elements in order"""
+
+    def elements(tree: Node) -> list:
+        if tree[0] == "+":  # type: ignore
+            return elements(tree[1]) + elements(tree[2])  # type: ignore
+        if tree[0] == "-":  # type: ignore
+            return [tree[1][0]]  # type: ignore
+        return list(tree)  # type: ignore
+
+    for n in [33, 34, 100, 1001, 100000]:
+        with subtests.test(n=n):
+            (tree,) = psll.macros.expand_array_literals((f"[{' '.join(map(str, range(n)))}]",))
+            assert elements(tree) == list(map(str, range(n)))
+            assert depth(tree) < 100
+    with subtests.test(msg="range"):
+        ast = psll.macros.range_keyword(psll.lexer.lex("(set a (range 0 10000))"))
+        assert depth(ast) < 100
+        psll.compile_source("(set a (range 0 1000))")  # Used to be too deep to process
+
+
 def test_string_expansion_string_expansion(subtests: Subtests) -> None:
     """> Make sure the prompt is expanded"""
     prompts = (random_string(N + 1) for N in range(10))
@@ -587,6 +628,231 @@ def test_string_expansion_nested(subtests: Subtests) -> None:
             assert depth(est) > depth(ast)
 
 
+def test_fold_constants(subtests: Subtests) -> None:
+    """> Fold the operations on integer literals, innermost first"""
+    trees = [
+        ("out", ("+", ("+", "1", "2"), "3")),
+        ("out", ("-", "1", ("*", "2", "3"))),
+        ("out", ("<=>", "-1", ("<=>", "8", "10"))),
+        ("out", ("=", "7", "7")),
+        ("out", ("^", "2", "10")),
+        ("out", ("^", "-1", "999999999")),
+        ("out", ("^", "0", "999999999")),
+        ("out", ("^", "-2", "5")),
+        ("out", ("+", "a", ("+", "1", "2"))),
+    ]
+    targets = [
+        ("out", "6"),
+        ("out", "-5"),
+        ("out", "0"),
+        ("out", "1"),
+        ("out", "1024"),
+        ("out", "-1"),
+        ("out", "0"),
+        ("out", "-32"),
+        ("out", ("+", "a", "3")),
+    ]
+    paired_test(subtests, trees, targets, psll.macros.fold_constants)
+
+
+def test_fold_constants_not_folded(subtests: Subtests) -> None:
+    """> Leave division, negative powers, longer results and non-integers alone"""
+    trees = [
+        ("out", ("/", "6", "3")),  # Always a float in Pyramid Scheme
+        ("out", ("^", "2", "-1")),
+        ("out", ("^", "9", "99")),
+        ("out", ("^", "10", "5000")),  # Too many digits to even turn into a string
+        ("out", ("^", "-7", "123456789")),
+        ("out", ("+", "1.5", "1")),
+        ("out", ("+", "01", "1")),
+        ("out", ("+", "a", "1")),
+        ("-", ("3", "0"), ("0", "0")),  # One-element array
+    ]
+    paired_test(subtests, trees, trees, psll.macros.fold_constants)
+
+
+def test_fold_constants_opt_in(subtests: Subtests) -> None:
+    """> Constant folding only runs when asked for, after the operator chains are expanded"""
+    ast = psll.lexer.lex("(out (+ 1 2 3 4))")
+    with subtests.test(msg="default"):
+        expected = psll.macros.apply_processing_stack(psll.lexer.lex("(out (+ (+ (+ 1 2) 3) 4))"))
+        assert psll.macros.apply_processing_stack(ast) == expected
+    with subtests.test(msg="optional"):
+        folded = psll.macros.apply_processing_stack(ast, optional=["fold_constants"])
+        assert folded == (("out", ("10", None, None), None),)
+    with subtests.test(msg="unknown"), pytest.raises(ValueError):
+        psll.macros.apply_processing_stack(ast, optional=["not_a_macro"])
+
+
+def test_balance_strings(subtests: Subtests) -> None:
+    """> Expand the strings into balanced trees of the same characters, in the same order"""
+
+    def characters(tree: tuple) -> str:
+        if tree[0] == "chr":
+            return chr(int(tree[2]))
+        return characters(tree[1]) + characters(tree[2])
+
+    for string in ["abcdefgh", "hello world", "x" * 10, "the quick brown fox jumps over the lazy dog" * 5]:
+        with subtests.test(string=string):
+            ast = ("out", f'"{string}"')
+            est = psll.macros.balance_strings(ast)
+            assert characters(est[1]) == string
+            assert depth(est) < depth(psll.macros.expand_string_literals(ast))
+
+
+def test_balance_strings_short(subtests: Subtests) -> None:
+    """> Leave the strings too short to balance to the usual string expansion"""
+    trees = [
+        ("out", '""'),
+        ("out", '"a"'),
+        ("out", '"ab"'),
+        ("set", "a", "b"),
+    ]
+    paired_test(subtests, trees, trees, psll.macros.balance_strings)
+
+
+def test_balance_strings_long() -> None:
+    """> Long strings only compile when balanced, since the left-deep chain is too deep to process"""
+    source = f'(out "{"abcdefghij" * 100}")'
+    with pytest.raises(RecursionError):
+        psll.compile_source(source)
+    result = psll.compile_source(source, optional=["balance_strings"])
+    assert result.metrics.lines < 1000
+
+
+def test_hoist_constants(subtests: Subtests) -> None:
+    """> Set the repeated constants to a free variable at the start of the program"""
+    text = '(set x 1) (out x "hello" "hello" "hello") (out "hi")'
+    ast = psll.compile_source(text).ast
+    hoisted = psll.compile_source(text, optional=["hoist_constants"]).ast
+    hello = psll.compile_source('(out "hello")').ast[0][1]
+    with subtests.test(msg="set"):
+        assert hoisted[0] == ("set", ("a", None, None), hello)
+        assert hoisted[1] == ast[0]
+    with subtests.test(msg="used"):
+        assert str(ast).count(str(hello)) == 3
+        assert str(hoisted).count(str(hello)) == 1
+        assert str(hoisted).count("('a', None, None)") == 4
+    with subtests.test(msg="not repeated"):
+        assert hoisted[-1] == ast[-1]
+    with subtests.test(msg="division"):
+        text = "(? 0 (out (- (/ 12 4) 1) (- (/ 12 4) 1) (- (/ 12 4) 1) (- (/ 12 4) 1)))"
+        ast = psll.compile_source(text).ast
+        hoisted = psll.macros.hoist_constants(ast)
+        quotient = ("-", ("/", ("12", None, None), ("4", None, None)), ("1", None, None))
+        assert hoisted[0] == ("set", ("a", None, None), quotient)  # Dividing by a non-zero literal cannot fail
+
+
+def test_hoist_constants_not_hoisted(subtests: Subtests) -> None:
+    """> Leave alone the constants used once, the subtrees which read variables, and the ones which can fail"""
+    texts = [
+        '(out "hello")',
+        "(out (+ x 1) (+ x 1) (+ x 1) (+ x 1))",
+        "(out (arg 1) (arg 1) (arg 1) (arg 1))",
+        "(out (chr 10) (chr 10))",  # Too small to be worth it
+        "(? 0 (out {0} {0} {0} {0}))".format("(+ (/ 1 0) 1)"),  # Would fail, even though the branch never runs
+        "(loop 0 (out {0} {0} {0} {0}))".format("(+ (^ 0 -1) 1)"),
+        "(? 0 (out {0} {0} {0} {0}))".format("(+ (chr 300) (chr 1))"),
+    ]
+    for text in texts:
+        with subtests.test(text=text):
+            ast = psll.compile_source(text).ast
+            assert psll.macros.hoist_constants(ast) == ast
+
+
+def test_hoist_constants_session() -> None:
+    """> Compile sessions hoist the constants of the whole program"""
+    text = '(out "hello")\n(out "hello")\n(out "hello")\n(set a 1)'
+    session = psll.compiler.CompileSession(optional=["hoist_constants"])
+    expected = psll.compile_source(text, optional=["hoist_constants"]).program
+    assert session.compile(text) == expected
+    text += "\n(out a)"  # Only the new form is processed again
+    assert session.compile(text) == psll.compile_source(text, optional=["hoist_constants"]).program
+
+
+def test_eliminate_dead_stores(subtests: Subtests) -> None:
+    """> Remove the sets of the variables which are never read, and count the removed pyramids"""
+    texts = [
+        "(set a 1) (out 2)",
+        "(set a 1) (set b a) (out 2)",  # b is dead, and then so is a
+        "((set a (+ 1 2)) (out 2))",
+        "(set a 1) (set b 2) (out b)",
+        "(set b 0) (loop (! b) ((set a 1) (set b 1)))",  # In the body of a loop
+    ]
+    targets: list[tuple[Any, int]] = [
+        ("(out 2)", 3),
+        ("(out 2)", 6),
+        ((("", None, ("out", ("2", None, None), None)),), 5),  # The bracket keeps an empty place
+        ("(set b 2) (out b)", 3),
+        (
+            (
+                ("set", ("b", None, None), ("0", None, None)),
+                ("loop", ("!", ("b", None, None), None), ("", None, ("set", ("b", None, None), ("1", None, None)))),
+            ),
+            3,
+        ),
+    ]
+    for text, (target, removed) in zip(texts, targets):
+        with subtests.test(text=text):
+            ast = psll.compile_source(text).ast
+            expected = psll.compile_source(target).ast if isinstance(target, str) else target
+            assert psll.macros.remove_dead_stores(ast) == (expected, removed)
+
+
+def test_eliminate_dead_stores_kept(subtests: Subtests) -> None:
+    """> Keep the sets of the variables which are read, and the ones with side effects"""
+    texts = [
+        "(set a 1) (out a)",
+        "(set a (out 1))",
+        "(set a ((set b 1) b))",
+        "(set a 1) (loop (! a) (set a 0))",
+        "(set a 1) (set a (+ a 1))",  # Reads itself
+        "(out (set a 1))",  # Not a statement
+        "(set n (# line)) (set m (# line)) (out m)",  # Reads a line of the input
+        "(out ((set a 5) 7))",  # An array, not a group of statements
+        "(set x ((set a 5) 7)) (out x)",
+        "(set x (? 1 (set a 5))) (out x)",  # The value of the body is used
+    ]
+    for text in texts:
+        with subtests.test(text=text):
+            ast = psll.compile_source(text).ast
+            assert psll.macros.remove_dead_stores(ast) == (ast, 0)
+    with subtests.test(msg="empty"):
+        ast = psll.compile_source("(set a 1)", optional=["eliminate_dead_stores"]).ast
+        assert ast == ("",)
+
+
+def test_symbol_table() -> None:
+    """> Look up the innermost def of each name, and keep the list of the defs up to date"""
+    defs: list[tuple[str, tuple]] = [("a", ("1",)), ("b", ("2",))]
+    table = psll.macros.SymbolTable(defs)
+    assert table["a"] == ("1",) and "c" not in table
+    table.push("a", ("3",))
+    assert table["a"] == ("3",) and len(table) == 2
+    assert defs[-1] == ("a", ("3",))
+    assert table.pop() == ("a", ("3",))
+    assert table["a"] == ("1",)
+    table.pop()
+    assert "b" not in table and defs == [("a", ("1",))]
+
+
+def test_def_keyword_shadowing(subtests: Subtests) -> None:
+    """> Defs shadow the ones of the same name until the end of their bracket"""
+    texts = [
+        "(def a (1)) (out a)",
+        "(def a (1)) (def a (2)) (out a)",
+        "(def a (1)) ((def a (2)) (out a)) (out a)",
+        "(def a (1)) (def b (+ a 1)) (def a (2)) (out b a)",
+    ]
+    targets = [
+        ((), ("out", ("1",))),
+        ((), (), ("out", ("2",))),
+        ((), ((), ("out", ("2",))), ("out", ("1",))),
+        ((), (), (), ("out", ("+", ("1",), "1"), ("2",))),
+    ]
+    paired_test(subtests, texts, targets, lambda text: psll.macros.def_keyword(psll.lexer.lex(text)))
+
+
 def test_bracket_expansion_1st_level(subtests: Subtests) -> None:
     """> Don't expand 1st level brackets (trees which are side-by-side)"""
     trees = [
@@ -706,3 +972,527 @@ def test_build_tree_invalid(subtests: Subtests) -> None:
     # TODO Split this into multiple tests
     trees = [(), (("set",), "a", "1")]
     error_test(subtests, trees, fun, RuntimeError)
+
+
+def test_render_to_matches_build(subtests: Subtests) -> None:
+    """> Streaming the program to a file gives the same result as building it"""
+    for _ in range(20):
+        ast = tuple(random_tree(max_depth=4) for _ in range(random.randrange(1, 4)))
+        with subtests.test(ast=ast):
+            buffer = StringIO()
+            lines, chars = psll.build.render_to(ast, buffer)
+            program = psll.build.build(ast)
+            assert buffer.getvalue() == program
+            assert (lines, chars) == (len(program.split("\n")), len(program))
+
+
+def test_parallel_build(subtests: Subtests) -> None:
+    """> Building the top-level trees in worker processes gives exactly the same program"""
+    asts = [compile_example(name) for name in ("xor", "nargin_counter")]
+    asts += [tuple(random_tree(max_depth=4) for _ in range(random.randrange(2, 10))) for _ in range(5)]
+    for ast in asts:
+        with subtests.test(ast=ast):
+            assert psll.build.build(ast, jobs=2) == psll.build.build(ast)
+
+
+def test_program_length_of_trees(subtests: Subtests) -> None:
+    """> Program length from the extents of the rows is the length of the built program"""
+    for _ in range(100):
+        ast = tuple(random_tree(max_depth=5) for _ in range(random.randrange(1, 6)))
+        with subtests.test(ast=ast):
+            length = psll.build.program_length_of_trees(psll.build.build_trees(ast))
+            assert length == len(psll.build.build(ast))
+            # The same from the contour of the first few trees
+            contour, k = psll.build.Contour(), random.randrange(len(ast))
+            for tree in psll.build.build_trees(ast[:k]):
+                contour.add(tree)
+            assert psll.build.program_length_of_trees(psll.build.build_trees(ast[k:]), contour) == length
+
+
+# ================================================
+#
+#  #####      ###    #####     ####   #####
+#  ##  ##    ## ##   ##  ##   ##      ##
+#  #####    ##   ##  #####     ###    #####
+#  ##       #######  ##  ##      ##   ##
+#  ##       ##   ##  ##   ##  ####    #####
+#
+# ================================================
+
+
+def canonical(node: Node) -> Node:
+    """Spell out the leaves of the ast as 3-tuples, as returned by the parser"""
+    if isinstance(node, str):
+        return (node, None, None)
+    elif node is None:
+        return None
+    return (node[0], canonical(node[1]), canonical(node[2]))
+
+
+def test_parse_round_trip(subtests: Subtests) -> None:
+    """> Parsing a built program gives back the ast"""
+    for _ in range(50):
+        ast = tuple(random_tree(max_depth=5) for _ in range(random.randrange(1, 5)))
+        ast = psll.macros.underscore_keyword(psll.macros.fill_in_underscores(ast))
+        with subtests.test(ast=ast):
+            assert psll.parser.parse(psll.build.build(ast)) == tuple(canonical(a) for a in ast)
+
+
+def test_parse_keywords(subtests: Subtests) -> None:
+    """> Keywords which look like bits of pyramids"""
+    for keyword in ("^", "-", "/", "<=>", "^^", "--"):
+        ast = ((keyword, (keyword, None, None), ("", None, (keyword, None, None))),)
+        with subtests.test(keyword=keyword):
+            assert psll.parser.parse(psll.build.build(ast)) == ast
+
+
+def test_parse_malformed(subtests: Subtests) -> None:
+    """> Pyramids without a base"""
+    texts = ["^", " ^\n/ \\", " ^\n/a\\\n-- ", "  ^\n / \\\n/   \\\n---- "]
+    error_test(subtests, texts, psll.parser.parse, psll.PsllSyntaxError)
+
+
+# =======================================================================
+#
+#   ####    #####    ######  ####  ###    ###  ####   ####   #####
+#  ##  ##   ##  ##     ##     ##   ## #  # ##   ##   ##      ##
+#  ##  ##   #####      ##     ##   ##  ##  ##   ##    ###    #####
+#  ##  ##   ##         ##     ##   ##      ##   ##      ##   ##
+#   ####    ##         ##    ####  ##      ##  ####  ####    #####
+#
+# =======================================================================
+
+
+def compile_example(name: str) -> tuple:
+    """Compile one of the examples into the (processed) ast"""
+    filename = os.path.join(os.path.dirname(__file__), "..", "examples", name + ".psll")
+    text = psll.preprocessor.preprocess(psll.preprocessor.read_file(filename))
+    return psll.macros.apply_processing_stack(psll.lexer.lex(text))
+
+
+OPTIMISERS: list[Callable[[tuple], tuple]] = [
+    partial(psll.optimisers.greedy_optimisation, verbose=False, max_iter=2),
+    partial(psll.optimisers.considerate_optimisation, verbose=False, max_iter=2),
+    partial(psll.optimisers.optimal_optimisation, verbose=False),
+    partial(psll.optimisers.beam_search_optimisation, beam_width=2, verbose=False, max_iter=2),
+    partial(psll.optimisers.annealing_optimisation, iterations=200, seed=0, verbose=False),
+]
+
+
+def test_statements_of_optimised(subtests: Subtests) -> None:
+    """> Optimisers preserve the statements of the program"""
+    for name in ("xor", "nargin_counter"):
+        ast = compile_example(name)
+        for optimiser in OPTIMISERS:
+            with subtests.test(example=name, optimiser=optimiser.func.__name__):  # type: ignore
+                optimised = optimiser(ast)
+                assert optimised != ast
+                assert psll.optimisers.statements(optimised) == psll.optimisers.statements(ast)
+                reparsed = psll.parser.parse(psll.build.build(optimised))
+                assert psll.optimisers.statements(reparsed) == psll.optimisers.statements(ast)
+
+
+def test_statements_flattening() -> None:
+    """> Empty pyramids are flattened only where their value is not used"""
+    a, b = ("a", None, None), ("b", None, None)
+    assert psll.optimisers.statements((("", a, ("", None, b)),)) == (a, b)
+    assert psll.optimisers.statements((("loop", a, ("", b, ("", None, None))),)) == (("loop", a, (b,)),)
+    # Arrays are empty pyramids too, and their shape matters
+    array = ("set", a, ("", a, b))
+    assert psll.optimisers.statements((array,)) == (array,)
+    assert psll.optimisers.statements((("set", a, ("", ("", a, None), b)),)) != (array,)
+
+
+def test_single_pyramid_optimisation(subtests: Subtests, tmp_path: Any) -> None:
+    """> Programs with a single top-level pyramid can be optimised too"""
+    ast = psll.macros.apply_processing_stack(psll.lexer.lex("(out 1)"))
+    assert len(ast) == 1
+    with subtests.test(msg="candidates"):
+        assert len(list(psll.optimisers.greedy_candidates(ast))) == 2
+        assert len(list(psll.optimisers.considerate_candidates(ast, 3))) == 4
+        assert list(psll.optimisers.greedy_candidates(())) == []
+    for optimiser in OPTIMISERS:
+        with subtests.test(optimiser=optimiser.func.__name__):  # type: ignore
+            optimised = optimiser(ast)
+            assert psll.optimisers.statements(optimised) == psll.optimisers.statements(ast)
+
+    with subtests.test(msg="optimise subcommand"):
+        filename = tmp_path / "one.pyra"
+        filename.write_text(psll.build.build(ast))
+        subprocess.check_call([sys.executable, "-m", "psll", "optimise", str(filename), "-o", "-f"])
+
+
+def test_optimal_optimisation_not_worse(subtests: Subtests) -> None:
+    """> Optimal optimisation never makes the program longer, and limiting the span still works"""
+    ast = compile_example("nargin_counter")
+    for max_span in (None, 1, 2, 3):
+        with subtests.test(max_span=max_span):
+            optimised = psll.optimisers.optimal_optimisation(ast, verbose=False, max_span=max_span)
+            assert len(psll.build.build(optimised)) <= len(psll.build.build(ast))
+            assert psll.optimisers.statements(optimised) == psll.optimisers.statements(ast)
+
+
+def test_beam_search_optimisation(subtests: Subtests) -> None:
+    """> Beam search is at least as good as the considerate optimisation, and respects the time budget"""
+    ast = compile_example("nargin_counter")
+    considerate = psll.optimisers.considerate_optimisation(ast, verbose=False, max_iter=2)
+    with subtests.test(beam_width=4):
+        optimised = psll.optimisers.beam_search_optimisation(ast, beam_width=4, verbose=False, max_iter=2)
+        assert len(psll.build.build(optimised)) <= len(psll.build.build(considerate))
+
+    with subtests.test(time_budget=0):
+        # No time at all still gives back a valid program
+        optimised = psll.optimisers.beam_search_optimisation(ast, time_budget=0, verbose=False)
+        assert psll.optimisers.statements(optimised) == psll.optimisers.statements(ast)
+
+    with subtests.test(msg="single pyramid"):
+        single = psll.macros.apply_processing_stack(psll.lexer.lex("(out 1)"))
+        optimised = psll.optimisers.beam_search_optimisation(single, beam_width=4, verbose=False, max_iter=2)
+        assert psll.optimisers.statements(optimised) == psll.optimisers.statements(single)
+
+
+def test_annealing_optimisation_seed(subtests: Subtests) -> None:
+    """> Annealing with the same seed gives the same program"""
+    ast = compile_example("nargin_counter")
+    for seed in (0, 1, 42):
+        with subtests.test(seed=seed):
+            first = psll.optimisers.annealing_optimisation(ast, iterations=200, seed=seed, verbose=False)
+            second = psll.optimisers.annealing_optimisation(ast, iterations=200, seed=seed, verbose=False)
+            assert first == second
+            assert len(psll.build.build(first)) <= len(psll.build.build(ast))
+
+    with subtests.test(msg="unbounded"), pytest.raises(ValueError):
+        psll.optimisers.annealing_optimisation(ast, iterations=None, time_budget=None)
+
+
+def test_annealing_moves() -> None:
+    """> Annealing moves keep the statements, and the ones which do not apply are None"""
+    a, b = ("a", None, None), ("b", None, None)
+    ast = (a, ("", b, None))
+    moves = {(i, move): psll.optimisers.annealing_move(ast, i, move) for i in range(2) for move in range(4)}
+    assert moves == {
+        (0, 0): (("", a, None), ("", b, None)),
+        (0, 1): (("", None, a), ("", b, None)),
+        (0, 2): (("", a, ("", b, None)),),
+        (0, 3): None,
+        (1, 0): (a, ("", ("", b, None), None)),
+        (1, 1): (a, ("", None, ("", b, None))),
+        (1, 2): None,
+        (1, 3): (a, b),
+    }
+
+
+def test_subtree_optimisation() -> None:
+    """> Regrouping the bodies of the keywords keeps the statements, and helps a program with long loops"""
+    ast = compile_example("bubble_sort")
+    optimised = psll.optimisers.subtree_optimisation(ast, verbose=False)
+    assert psll.optimisers.statements(optimised) == psll.optimisers.statements(ast)
+    assert len(psll.build.build(optimised)) < len(psll.build.build(ast))
+    reparsed = psll.parser.parse(psll.build.build(optimised))
+    assert psll.optimisers.statements(reparsed) == psll.optimisers.statements(ast)
+
+
+def test_group_statements(subtests: Subtests) -> None:
+    """> Grouped statements come out in the same order"""
+    for n in range(1, 6):
+        stmts = tuple(random_tree(max_depth=3) for _ in range(n))
+        with subtests.test(stmts=stmts):
+            grouped = psll.optimisers.group_statements(stmts)
+            expected = [t for s in stmts for t in psll.optimisers.statement_list(s)]
+            assert psll.optimisers.statement_list(grouped) == expected
+
+
+def test_checkpoint_resume(tmp_path: Any, subtests: Subtests) -> None:
+    """> Resuming an interrupted optimisation from a checkpoint gives the same result as not interrupting it"""
+    filename = str(tmp_path / "checkpoint.json")
+    ast = compile_example("nargin_counter")
+    for optimiser in (psll.optimisers.greedy_optimisation, psll.optimisers.considerate_optimisation):
+        with subtests.test(optimiser=optimiser.__name__):
+            checkpointer = psll.optimisers.Checkpointer(filename)
+            optimiser(ast, verbose=False, max_iter=1, checkpointer=checkpointer)
+            state = psll.optimisers.load_checkpoint(filename)
+            assert state.optimiser in optimiser.__name__
+            assert psll.optimisers.statements(state.ast) == psll.optimisers.statements(ast)
+
+            resumed = optimiser(state.ast, verbose=False, start_iter=state.iteration)
+            assert resumed == optimiser(ast, verbose=False)
+
+    with subtests.test(msg="round trip"):
+        for _ in range(10):
+            state = psll.optimisers.checkpoint(tuple(random_tree() for _ in range(3)), 7, "greedy")
+            psll.optimisers.save_checkpoint(filename, state)
+            assert psll.optimisers.load_checkpoint(filename) == state
+
+
+def test_progress_events(subtests: Subtests) -> None:
+    """> Optimisers report their progress after each iteration"""
+    ast = compile_example("nargin_counter")
+    for optimiser in (psll.optimisers.greedy_optimisation, psll.optimisers.considerate_optimisation):
+        with subtests.test(optimiser=optimiser.__name__):
+            events: list[psll.optimisers.progress_event] = []
+            optimised = optimiser(ast, verbose=False, progress=events.append)
+            assert [e.iteration for e in events] == list(range(1, len(events) + 1))
+            assert events[-1].best_length == len(psll.build.build(optimised))
+            assert all(e.candidates > 0 and e.iteration_time >= 0 for e in events)
+            assert all(e.cache_hit_rate is None or 0 <= e.cache_hit_rate <= 1 for e in events)
+
+
+def test_optimisation_objectives(subtests: Subtests) -> None:
+    """> Optimisers minimise the cost they are given"""
+    ast = compile_example("nargin_counter")
+    metrics = lambda ast: psll.build.metrics(psll.build.build_program_tree(ast))
+    assert metrics(ast).bytes == len(psll.build.build(ast))
+
+    costs = {**psll.optimisers.COSTS, "weighted": psll.optimisers.weighted_cost(1, 0, 20)}
+    for name, cost in costs.items():
+        with subtests.test(cost=name):
+            optimised = psll.optimisers.considerate_optimisation(ast, verbose=False, max_iter=2, cost=cost)
+            assert cost(metrics(optimised)) <= cost(metrics(ast))
+            assert psll.optimisers.statements(optimised) == psll.optimisers.statements(ast)
+
+
+def test_pareto_optimisation() -> None:
+    """> None of the variants in the Pareto front is better than another one in all the objectives"""
+    ast = compile_example("nargin_counter")
+    front = psll.optimisers.pareto_optimisation(ast, verbose=False, max_iter=2, max_front=4)
+    assert 1 < len(front) <= 4
+    for metrics, variant in front:
+        assert metrics == psll.build.metrics(psll.build.build_program_tree(variant))
+        assert psll.optimisers.statements(variant) == psll.optimisers.statements(ast)
+        assert not any(psll.optimisers.dominates(other, metrics) for other, _ in front)
+
+    # A single pyramid has no pairs to group, but it can still be wrapped
+    single = psll.macros.apply_processing_stack(psll.lexer.lex("(out 1)"))
+    front = psll.optimisers.pareto_optimisation(single, verbose=False, max_iter=2, max_front=4)
+    assert (psll.build.metrics(psll.build.build_program_tree(single)), single) in front
+
+
+# ===============================================================
+#
+#   ####   #####   ####    ####   ####   ####    ##     ##
+#  ##      ##     ##      ##       ##   ##  ##   ####   ##
+#   ###    #####   ###     ###     ##   ##  ##   ##  ## ##
+#     ##   ##        ##      ##    ##   ##  ##   ##    ###
+#  ####    #####  ####    ####    ####   ####    ##     ##
+#
+# ===============================================================
+
+
+def test_session_matches_full_compile(subtests: Subtests) -> None:
+    """> Compile session gives the same ast and program as compiling from scratch"""
+    examples = os.path.join(os.path.dirname(__file__), "..", "examples")
+    for name in ("arrays", "def_keyword", "bubble_sort", "modulo_function"):
+        with subtests.test(example=name):
+            text = psll.preprocessor.read_file(os.path.join(examples, name + ".psll"))
+            session = psll.compiler.CompileSession()
+            ast = session.process(text)
+            assert ast == compile_example(name)
+            assert session.build(ast) == psll.build.build(ast)
+
+            session.process(text)  # Nothing changed
+            assert (session.reused, session.processed) == (len(ast), 0)
+
+
+def test_session_incremental(subtests: Subtests) -> None:
+    """> Only the changed forms, and the ones which see changed defs, get processed again"""
+    before = "(def a (+ 1 2))\n(out a)\n(set xyz 3)\n(out (* xyz 2))\n(out a)"
+    changes = {
+        "one form": ("(out (* xyz 2))", "(out (* xyz 5))", 1),
+        "def": ("(def a (+ 1 2))", "(def a (+ 1 3))", 3),
+        "long name": ("xyz", "xw", 0),  # Still shortens to the same name
+    }
+    for msg, (old, new, processed) in changes.items():
+        with subtests.test(msg=msg):
+            session = psll.compiler.CompileSession()
+            session.process(before)
+            after = before.replace(old, new)
+            ast = session.process(after)
+            assert ast == psll.macros.apply_processing_stack(psll.lexer.lex(psll.preprocessor.preprocess(after)))
+            assert session.processed == processed
+
+
+def test_watch(tmp_path: Any) -> None:
+    """> Watching yields all the files first, and then only the changed ones"""
+    a, b = tmp_path / "a.psll", tmp_path / "b.psll"
+    a.write_text("(out 1)")
+    b.write_text("(out 2)")
+    edits = iter(
+        [
+            lambda: None,  # Nothing changes in the first poll
+            lambda: b.write_text("(out 22)"),
+            lambda: a.unlink(),  # Missing files are not changes...
+            lambda: a.write_text("(out 111)"),  # ...until they appear again
+        ]
+    )
+    changes = psll.compiler.watch([str(a), str(b)], sleep=lambda _: next(edits)())
+    assert next(changes) == [str(a), str(b)]
+    assert next(changes) == [str(b)]
+    assert next(changes) == [str(a)]
+
+
+def test_watch_options(tmp_path: Any, subtests: Subtests) -> None:
+    """> Options which watching would silently ignore are rejected"""
+    source, checkpoint = tmp_path / "a.psll", tmp_path / "a.json"
+    source.write_text("(out 1)")
+    checkpoint.write_text("{}")  # Only needs to exist
+    for option in (["--checkpoint", str(checkpoint)], ["--resume", str(checkpoint)]):
+        with subtests.test(option=option[0]):
+            command = [sys.executable, "-m", "psll", "compile", str(source), "--watch", *option]
+            result = subprocess.run(command, capture_output=True, text=True, timeout=60)  # Or it would watch
+            assert result.returncode != 0
+            assert "--watch cannot be used with" in result.stderr
+
+
+def test_compile_server(tmp_path: Any, subtests: Subtests) -> None:
+    """> Compile server gives the same programs as compiling in-process, and caches them"""
+    path = str(tmp_path / "psll.sock")
+    compile_server = psll.server.CompileServer(path, workers=2, cache_size=2)
+    thread = threading.Thread(target=compile_server.serve_forever)
+    thread.start()
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        examples = os.path.join(os.path.dirname(__file__), "..", "examples")
+        names = ("arrays", "def_keyword", "bubble_sort", "modulo_function", "xor")
+        texts = [psll.preprocessor.read_file(os.path.join(examples, name + ".psll")) for name in names]
+        expected = [psll.compiler.CompileSession().compile(text) for text in texts]
+
+        with subtests.test(msg="concurrent"):
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                responses = list(pool.map(lambda text: psll.server.request(path, text), texts))
+            assert [response["program"] for response in responses] == expected
+
+        with subtests.test(msg="cached"):
+            first = psll.server.request(path, texts[0], {"full_names": True})
+            second = psll.server.request(path, texts[0], {"full_names": True})
+            assert (first["cached"], second["cached"]) == (False, True)
+            assert first["program"] == second["program"]
+            assert second["metrics"]["bytes"] == len(second["program"])
+            assert len(compile_server.cache) == 2
+
+        with subtests.test(msg="error"):
+            response = psll.server.request(path, "((")
+            assert "PsllSyntaxError" in response["error"]
+
+        with subtests.test(msg="already running"), pytest.raises(FileExistsError):
+            psll.server.CompileServer(path).serve_forever()
+    finally:
+        compile_server.shutdown()
+        thread.join()
+    assert not os.path.exists(path)
+
+
+def test_stale_socket(tmp_path: Any) -> None:
+    """> Only sockets which nobody listens on are removed before serving"""
+    path = str(tmp_path / "psll.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(path)  # Closed without removing it, like a server which crashed
+    psll.server.remove_stale_socket(path)
+    assert not os.path.exists(path)
+
+    with open(path, "w") as f:
+        f.write("not a socket")
+    with pytest.raises(FileExistsError):
+        psll.server.CompileServer(path).serve_forever()
+    assert os.path.isfile(path)
+
+
+def test_lazy_imports(subtests: Subtests) -> None:
+    """> Importing psll and its cli does not import the compiler, the optimisers or numpy"""
+    code = (
+        "import sys, {module}; print(' '.join(sorted(m for m in sys.modules"
+        " if m.split('.')[0] in ('psll', 'numpy', 'more_itertools'))))"
+    )
+    expected = {"psll": "psll", "psll.__main__": "psll psll.__main__"}
+    for module, loaded in expected.items():
+        with subtests.test(module=module):
+            output = subprocess.check_output([sys.executable, "-c", code.format(module=module)], text=True)
+            assert output.strip() == loaded
+
+    with subtests.test(msg="attribute access"):
+        assert psll.preprocessor.preprocess("(out 1)") == "(out 1)"
+        with pytest.raises(AttributeError):
+            psll.not_a_module  # noqa: B018
+
+
+def test_read_programs(subtests: Subtests) -> None:
+    """> NUL-separated programs are split up, ignoring the whitespace after the last separator"""
+    cases = {
+        "(out 1)": ["(out 1)"],
+        "(out 1)\0(out 2)\n\0\n": ["(out 1)", "(out 2)\n"],
+        "(out\n1)\0\0(out 3)": ["(out\n1)", "", "(out 3)"],
+        "": [],
+    }
+    for text, programs in cases.items():
+        with subtests.test(text=text):
+            assert list(psll.preprocessor.read_programs(StringIO(text))) == programs
+
+    with subtests.test(msg="pipe"):
+        # Each program comes out as soon as its separator is written, without waiting for a newline
+        r, w = os.pipe()
+        with open(r) as reader, open(w, "w") as writer, ThreadPoolExecutor(max_workers=1) as pool:
+            stream = psll.preprocessor.read_programs(reader)
+            writer.write("(out 1)\0(out")
+            writer.flush()
+            try:
+                assert pool.submit(next, stream).result(timeout=10) == "(out 1)"
+            finally:
+                writer.write(" 2)")
+                writer.close()
+            assert list(stream) == ["(out 2)"]
+
+
+def test_compile_stdin() -> None:
+    """> Programs piped into `psll compile -` come out in the same order, separated the same way"""
+    texts = ["(out 1)", '(out "Hello, World!")', "(set a 1) (out (+ a 2))"]
+    output = subprocess.check_output(
+        [sys.executable, "-m", "psll", "compile", "-"],
+        input="\0".join(texts),
+        text=True,
+    )
+    expected = [psll.build.build(psll.macros.apply_processing_stack(psll.lexer.lex(text))) for text in texts]
+    assert output.split("\0") == [program + "\n" for program in expected]
+
+    # Programs which do not compile get an empty output, and the rest of the stream carries on
+    result = subprocess.run(
+        [sys.executable, "-m", "psll", "compile", "-"],
+        input="\0".join([texts[0], "", "((", texts[1]]),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.split("\0") == [expected[0] + "\n", "", "", expected[1] + "\n"]
+    assert "program 1:" in result.stderr and "program 2:" in result.stderr
+
+
+def test_compile_source(subtests: Subtests) -> None:
+    """> In-process compile API gives the same program as the processing stack and build"""
+    examples = os.path.join(os.path.dirname(__file__), "..", "examples")
+    names = ("arrays", "def_keyword", "bubble_sort", "xor")
+    texts = [psll.preprocessor.read_file(os.path.join(examples, name + ".psll")) for name in names]
+
+    for name, text in zip(names, texts):
+        with subtests.test(example=name):
+            result = psll.compile_source(text)
+            assert result.ast == compile_example(name)
+            assert result.program == psll.build.build(result.ast)
+            assert result.metrics == psll.build.metrics(psll.build.build_program_tree(result.ast))
+            assert list(result.timings) == ["preprocess", "lex", "macros", "optimise", "build"]
+
+    with subtests.test(msg="optimiser"):
+        ast = compile_example("xor")
+        optimised = psll.compile_source(texts[-1], optimiser="considerate").ast
+        assert optimised == psll.optimisers.considerate_optimisation(ast, verbose=False)
+        assert psll.compile_source(texts[-1], optimiser=lambda ast: ast).ast == ast
+        with pytest.raises(ValueError):
+            psll.compile_source(texts[-1], optimiser="not an optimiser")
+
+    with subtests.test(msg="empty"):
+        for text in ("", "   \n", "// only a comment"):
+            with pytest.raises(psll.PsllSyntaxError):
+                psll.compile_source(text)
+
+    with subtests.test(msg="threads"):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            programs = list(pool.map(lambda text: psll.compile_source(text).program, texts * 4))
+        assert programs == [psll.compile_source(text).program for text in texts] * 4